@@ -1,5 +1,6 @@
 from LSTMGraph import LSTMGraph
 import numpy as np
+import time
 
 class LSTM:
     def __init__(self, nb_inputs, learning_rate=0.01, debug=False):
@@ -7,12 +8,16 @@ class LSTM:
         self.learning_rate = learning_rate
         self.callbacks = []
         self.callback_periods = []
+        # mesure des appels au graphe, hors du graphe compilé (désactivée par défaut)
+        self.instrumentation = False
+        self.instrumentation_callbacks = []
 
     def add_callback(self, callback, period):
         """
         Ajoute un callback à appeler toutes les periodes fois
         :param callback: callback (prend en paramètre l'erreur, la sortie, le nombre d'exemple ont déjà été traités et le nombre d'exple total) 
-        callback(cost, out, count, total)
+        callback(cost, out, count, total), out étant la sortie du dernier lot :
+        temps x sorties si batch_size vaut 1, temps x lot x sorties sinon
         :param period: on appelle le callback tous les period périodes
         """
         self.callbacks.append(callback)
@@ -37,6 +42,60 @@ class LSTM:
         self.add_callback(callback, period)
         return self
 
+    def add_instrumentation_callback(self, callback):
+        """
+        Ajoute un callback appelé après chaque appel au graphe (entrainement,
+        prédiction) quand l'instrumentation est activée
+        :param callback: callback(stats), stats un dict avec 'function' (nom de la
+        fonction du graphe), 'steps' (nombre de pas de temps calculés), 'lengths'
+        (longueur de chaque séquence) et 'time' (durée de l'appel en secondes)
+        """
+        self.instrumentation_callbacks.append(callback)
+        return self
+
+    def add_timing_callback(self):
+        """
+        Affiche le nombre de pas de temps et la durée de chaque appel au graphe,
+        et active l'instrumentation
+        """
+        callback = lambda stats: print(stats['function'], ': ', stats['steps'], ' pas en ', round(stats['time'], 3), 's', sep='')
+        self.add_instrumentation_callback(callback)
+        self.set_instrumentation(True)
+        return self
+
+    def set_instrumentation(self, enabled=True):
+        """
+        Active ou désactive l'instrumentation des appels au graphe
+        """
+        self.instrumentation = enabled
+        return self
+
+    def call_graph(self, name, *args):
+        """
+        Appelle une fonction du graphe, en la mesurant si l'instrumentation est activée
+        :param name: nom de la fonction du graphe (train, train_batch ou predict)
+        :param args: paramètres de la fonction
+        """
+        fn = getattr(self.graph, name)
+        if not self.instrumentation:
+            return fn(*args)
+        start = time.perf_counter()
+        result = fn(*args)
+        duration = time.perf_counter() - start
+        if name == 'train_batch':
+            steps = len(args[0])
+            lengths = [int(n) for n in np.sum(args[1], axis=0)]  # d'après le masque
+        elif name == 'predict':
+            steps = len(result)
+            lengths = [steps]
+        else:
+            steps = len(args[0])
+            lengths = [steps]
+        stats = {'function': name, 'steps': steps, 'lengths': lengths, 'time': duration}
+        for callback in self.instrumentation_callbacks:
+            callback(stats)
+        return result
+
     def add_lstm_layer(self, length, weights=None, biases=None, **params):
         """
         Ajoute une couche LSTM
@@ -79,27 +138,53 @@ class LSTM:
         self.graph.save_weights(file)
         return self
 
-    def train(self, x_train, y_train, epochs=1):
+    def train(self, x_train, y_train, epochs=1, batch_size=1):
         """
         Entraine le réseau
         :param x_train: liste des entrées
         :param y_train: liste des sorties attendues
         :param epochs: nombre de fois 
+        :param batch_size: nombre d'exemples par mise à jour des poids
         """
         count = 0  # On compte le nombre d'exemple on a vu pour le callback
         total = epochs * len(x_train)
         nb_callbacks = len(self.callbacks)
         for epoch in range(epochs): # Nombre de fois qu'on re-entraine avec les mêmes données
-            for k in np.random.permutation(len(x_train)):  # On utilise un ordre différent à chaque fois
-                x, y = x_train[k], y_train[k]
-                cost, out, deb = self.graph.train(x, y, self.learning_rate)
-                # On appelle les callbacks ajoutés
+            order = np.random.permutation(len(x_train))  # On utilise un ordre différent à chaque fois
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start+batch_size]
+                if batch_size == 1:
+                    x, y = x_train[batch[0]], y_train[batch[0]]
+                    cost, out = self.call_graph('train', x, y, self.learning_rate)
+                else:
+                    x, mask, y = self.pad_batch([x_train[k] for k in batch], [y_train[k] for k in batch])
+                    cost, out = self.call_graph('train_batch', x, mask, y, self.learning_rate)
+                # On appelle les callbacks ajoutés, une fois par lot, si le lot
+                # contient un exemple multiple de leur période
                 for num_callback in range(nb_callbacks):
-                    if count % self.callback_periods[num_callback] == 0:
-                        self.callbacks[num_callback](cost, out, count+1, total)
-                count += 1
+                    period = self.callback_periods[num_callback]
+                    if -(-count // period) * period < count + len(batch):
+                        self.callbacks[num_callback](cost, out, count+len(batch), total)
+                count += len(batch)
         return self
 
+    def pad_batch(self, x_list, y_list):
+        """
+        Regroupe des séquences de longueurs différentes en un lot, complété par des zéros
+        :param x_list: liste des entrées (temps x entrées)
+        :param y_list: liste des sorties attendues (temps x sorties)
+        :return: entrées (temps x lot x entrées), masque (temps x lot), sorties (temps x lot x sorties)
+        """
+        length = max(len(x) for x in x_list)
+        x_batch = np.zeros((length, len(x_list), np.shape(x_list[0])[1]), dtype=np.float32)
+        y_batch = np.zeros((length, len(y_list), np.shape(y_list[0])[1]), dtype=np.float32)
+        mask = np.zeros((length, len(x_list)), dtype=np.float32)
+        for k in range(len(x_list)):
+            x_batch[:len(x_list[k]), k] = x_list[k]
+            y_batch[:len(y_list[k]), k] = y_list[k]
+            mask[:len(x_list[k]), k] = 1
+        return x_batch, mask, y_batch
+
     def predict(self, x, stop_condition, max_temps):
         """
         Execute le reseau et donne la valeur suivante
@@ -108,4 +193,4 @@ class LSTM:
         :param max_temps: valeur de tour de boucle max dans tous les cas
         :return: liste de toutes les sorties au cours du temps
         """
-        return self.graph.predict(x, stop_condition, max_temps)
\ No newline at end of file
+        return self.call_graph('predict', x, stop_condition, max_temps)
\ No newline at end of file
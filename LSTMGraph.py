@@ -3,23 +3,13 @@
 import numpy as np
 from theano import function, shared, scan, config, scan_module
 from theano.ifelse import ifelse
-import theano.printing as pr 
 import theano.tensor as T
 import pickle
 
 print(config.device, config.force_device)
 
-def print_callback_fn(op, xin):
-    for attr in op.attrs:
-        temp = getattr(xin, attr)
-        if callable(temp):
-            pmsg = temp()
-        else:
-            pmsg = temp
-        pmsg = int(pmsg)
-        if pmsg%10 == 0:
-            pass
-            #print(pmsg)
+# ordre des portes dans les poids regroupés des couches LSTM
+LSTM_GATES = ['f', 'i', 'o', 'c']
 
 class LSTMGraph:
     def __init__(self, nb_inputs=None, learning_rate=0.01, bptt_truncate=-1, debug=False):
@@ -30,9 +20,8 @@ class LSTMGraph:
         self.learning_rate = learning_rate
         self.bptt_truncate = bptt_truncate
         self.debug = debug
-        # self.print_callback = pr._print_fn
-        self.print_callback = print_callback_fn
         self.train = lambda: print('Utiliser init_train pour activer cette fonction.')
+        self.train_batch = lambda: print('Utiliser init_train pour activer cette fonction.')
         self.cost = lambda: print('Utiliser init_train pour activer cette fonction.')
         self.BPTT = lambda: print('Utiliser init_train pour activer cette fonction.')
         self.predict = lambda: print('Utiliser init_train pour activer cette fonction.')
@@ -120,29 +109,11 @@ class LSTMGraph:
             x = T.matrix('x', dtype=config.floatX)  # On créé un vecteur d'entrée de type double
             expected = T.matrix('expected', dtype=config.floatX)  # Valeur attendue
             learning_rate = T.scalar('learning_rate')  # vitesse d'apprentissage
-            num_passage = 0
-
-            outputs_info = [None] # paramètres évolutifs à fournir au model_layers, None correspond à la sortie finale du réseau qui n'a pas de valeur initiale
-
-            for layer in self.layers:
-                if layer['type'] == 'lstm':
-                    outputs_info.append(T.zeros(layer['length']))  # h_prev
-                    outputs_info.append(T.zeros(layer['length']))  # c_prev
-            
-            outputs_info.append(num_passage)
 
             self.debug_print('Définition de la structure des couches.')
 
-            outputs, updates = scan(  # On fait une boucle sur le model (dans le temps)
-                fn=self.model_layers,  # fonction appliqué à chaque étape
-                sequences=x,  # on boucle sur le nombre d'entrée
-                truncate_gradient=self.bptt_truncate,  # Nombre d'étape pour le truncate BPTT (backpropagation through time)
-                                                        # Si égale à -1, on utilise le BPTT classique
-                outputs_info=outputs_info # Initialisation des paramètres données à fn
-            )
-
-            last_output = outputs[0]  # Sortie finale, les autres sont les valeurs des mémoires intermédiaires
-            debug_print = outputs[-1]
+            # toute la séquence, couche par couche
+            last_output = self.model_sequence(x)
 
         if callback is not None:
             stop = callback()
@@ -153,20 +124,7 @@ class LSTMGraph:
 
             self.debug_print('Calcul des gradients.')
 
-            updates = []  # Modifs
-            grads = []  # Gradients
-
-            for k in range(len(self.layers)):
-                layer_type = self.layers[k]['type']
-                if layer_type != 'input': # pas de gradient pour l'entrée
-                    for w in self.layers[k]['weights'].keys():
-                        grads.append(T.grad(cost, self.layers[k]['weights'][w]))
-                        update = (self.layers[k]['weights'][w], self.layers[k]['weights'][w] - learning_rate * grads[-1])
-                        updates.append(update)  # Liste des modifs à faire pour la propagtion du gradient
-                    for w in self.layers[k]['biases'].keys():
-                        grads.append(T.grad(cost, self.layers[k]['biases'][w]))
-                        update = (self.layers[k]['biases'][w], self.layers[k]['biases'][w] - learning_rate * grads[-1])
-                        updates.append(update)  # Liste des modifs à faire pour la propagtion du gradient
+            grads, updates = self.gradient_updates(cost, learning_rate)
 
             self.debug_print('Compilation des fonctions BPTT et cost.')
 
@@ -189,11 +147,9 @@ class LSTMGraph:
                     outputs_info.append(T.zeros(layer['length']))  # h_prev
                     outputs_info.append(T.zeros(layer['length']))  # c_prev
 
-            outputs_info.append(0)
-
             o, updated = scan(  # On fait une boucle sur le model (dans le temps)
                 fn=self.model_layers_predict,  # fonction appliqué à chaque étape
-                non_sequences=[num_passage, arret],  
+                non_sequences=[arret],
                 outputs_info=outputs_info, # Initialisation des paramètres données à fn
                 n_steps=max_temps
             )
@@ -207,7 +163,9 @@ class LSTMGraph:
             self.debug_print('Compilation de la fonction d\'apprentissage.')
 
             # Création de la fonction d'entrainement
-            self.train = function([x, expected, learning_rate], [cost, last_output, debug_print], updates=updates, allow_input_downcast=True)
+            self.train = function([x, expected, learning_rate], [cost, last_output], updates=updates, allow_input_downcast=True)
+            # la fonction d'entrainement par lots n'est compilée qu'au premier lot
+            self.train_batch = self.compile_train_batch
 
             self.debug_print('Graphe initialisé.')
 
@@ -215,6 +173,54 @@ class LSTMGraph:
 
         return self
 
+    def init_train_batch(self):
+        """
+        Créé la fonction d'apprentissage par lots de séquences de longueurs
+        différentes, complétées par des zéros (une mise à jour des poids par lot)
+        """
+        self.debug_print('Compilation de la fonction d\'apprentissage par lots.')
+
+        x_batch = T.tensor3('x_batch', dtype=config.floatX)  # temps x lot x entrées
+        expected_batch = T.tensor3('expected_batch', dtype=config.floatX)
+        mask = T.matrix('mask', dtype=config.floatX)  # temps x lot, 1 pour les étapes des séquences
+        learning_rate = T.scalar('learning_rate')
+        batch_output = self.model_sequence(x_batch)
+        # erreur des étapes non complétées, moyennée sur le lot
+        batch_cost = T.sum(T.sum(self.error(expected_batch, batch_output), axis=2) * mask) / T.cast(mask.shape[1], config.floatX)
+        _, batch_updates = self.gradient_updates(batch_cost, learning_rate)
+        self.train_batch = function([x_batch, mask, expected_batch, learning_rate], [batch_cost, batch_output], updates=batch_updates, allow_input_downcast=True)
+        return self
+
+    def compile_train_batch(self, x_batch, mask, expected_batch, learning_rate):
+        """
+        train_batch avant son premier appel : compile la fonction puis l'appelle
+        """
+        self.init_train_batch()
+        return self.train_batch(x_batch, mask, expected_batch, learning_rate)
+
+    def gradient_updates(self, cost, learning_rate):
+        """
+        Gradients de l'erreur et mises à jour des poids (descente de gradient)
+        :param cost: erreur à minimiser
+        :param learning_rate: vitesse d'apprentissage
+        :return: gradients, mises à jour
+        """
+        updates = []  # Modifs
+        grads = []  # Gradients
+
+        for k in range(len(self.layers)):
+            layer_type = self.layers[k]['type']
+            if layer_type != 'input': # pas de gradient pour l'entrée
+                for w in self.layers[k]['weights'].keys():
+                    grads.append(T.grad(cost, self.layers[k]['weights'][w]))
+                    update = (self.layers[k]['weights'][w], self.layers[k]['weights'][w] - learning_rate * grads[-1])
+                    updates.append(update)  # Liste des modifs à faire pour la propagtion du gradient
+                for w in self.layers[k]['biases'].keys():
+                    grads.append(T.grad(cost, self.layers[k]['biases'][w]))
+                    update = (self.layers[k]['biases'][w], self.layers[k]['biases'][w] - learning_rate * grads[-1])
+                    updates.append(update)  # Liste des modifs à faire pour la propagtion du gradient
+        return grads, updates
+
     def generate_weights(self, rows, cols):
         """
         Génère des poids de taille donnée
@@ -280,12 +286,58 @@ class LSTMGraph:
                 'bo': self.generate_weights(1, nb_neurons),
                 'bc': self.generate_weights(1, nb_neurons)
             }
+        weights, biases = self.fuse_lstm_weights(weights, biases)
         # On initialise les variables hybrides de theano
         for w, weight in weights.items():
             self.layers[layer]['weights'][w] = shared(weight.astype(config.floatX))
         for b, biase in biases.items():
             self.layers[layer]['biases'][b] = shared(biase.astype(config.floatX))
 
+    def fuse_lstm_weights(self, weights, biases):
+        """
+        Regroupe les poids par porte (Wf, Uf, bf, ...) d'une couche LSTM en
+        W (entrées x 4*taille), U (taille x 4*taille) et b (4*taille),
+        les portes dans l'ordre de LSTM_GATES
+        :param weights: poids par porte, ou déjà regroupés
+        :param biases: biases par porte, ou déjà regroupés
+        """
+        if 'W' not in weights:
+            weights = {
+                'W': np.concatenate([weights['W' + g] for g in LSTM_GATES], axis=1),
+                'U': np.concatenate([weights['U' + g] for g in LSTM_GATES], axis=1)
+            }
+        if 'b' not in biases:
+            biases = {
+                'b': np.concatenate([biases['b' + g] for g in LSTM_GATES])
+            }
+        return weights, biases
+
+    def split_lstm_weights(self, weights, biases):
+        """
+        Sépare les poids regroupés d'une couche LSTM en poids par porte
+        (format des sauvegardes), voir fuse_lstm_weights
+        """
+        gates = len(LSTM_GATES)
+        W = np.split(weights['W'], gates, axis=1)
+        U = np.split(weights['U'], gates, axis=1)
+        b = np.split(biases['b'], gates)
+        weights, biases = {}, {}
+        for k, g in enumerate(LSTM_GATES):
+            weights['W' + g] = W[k]
+            weights['U' + g] = U[k]
+            biases['b' + g] = b[k]
+        return weights, biases
+
+    def gate(self, gates, k, length):
+        """
+        Extrait la porte k d'un produit par les poids regroupés
+        :param gates: produit (dernier axe de taille 4*length)
+        :param length: taille de la couche
+        """
+        if gates.ndim == 1:
+            return gates[k*length:(k+1)*length]
+        return gates[:, k*length:(k+1)*length]
+
 
     def model_layers(self, x, *args):
         """
@@ -296,9 +348,7 @@ class LSTMGraph:
         args = list(args)
         num_arg = 0
         outputs = []
-        num_passage = args[-1]
         for k in range(len(self.layers)):
-            debug_printing = pr.Print('Progress', global_fn=self.print_callback)(num_passage+1)
             layer = self.layers[k]
             if layer['type'] == 'simple':  # si c'est un simple on utilise le model simple
                 x = self.model_simple_layer(x, k)
@@ -309,9 +359,34 @@ class LSTMGraph:
                 outputs.append(h)  # nouveau h
                 outputs.append(c)  # nouveau x
         outputs = [x] + outputs  # les sorties sont la sortie finale x et les valeurs intermédiaires à repasser au réseau au temps suivant
-        outputs.append(debug_printing)
         return tuple(outputs)  # x (output), vals_t, ...
 
+    def model_sequence(self, x):
+        """
+        Définie le model sur toute une séquence d'entrées, couche par couche :
+        la projection des entrées de chaque couche LSTM est calculée pour toute
+        la séquence en un seul produit, la boucle dans le temps ne porte que
+        sur la sortie précédente
+        :param x: séquence d'entrées (temps x entrées), ou lot de séquences (temps x lot x entrées)
+        :return: séquence de sorties
+        """
+        for k in range(len(self.layers)):
+            layer = self.layers[k]
+            if layer['type'] == 'simple':  # pas de récurrence, appliquée à toute la séquence
+                x = self.model_simple_layer(x, k)
+            elif layer['type'] == 'lstm':
+                xw = T.dot(x, layer['weights']['W']) + layer['biases']['b']
+                # une mémoire par séquence du lot
+                shape = (x.shape[1], layer['length']) if x.ndim == 3 else (layer['length'],)
+                (x, _), _ = scan(  # On fait une boucle sur la couche (dans le temps)
+                    fn=lambda xw_t, h_prev, c_prev, k=k: self.model_lstm_step(xw_t, h_prev, c_prev, k),
+                    sequences=xw,
+                    truncate_gradient=self.bptt_truncate,  # Nombre d'étape pour le truncate BPTT (backpropagation through time)
+                                                            # Si égale à -1, on utilise le BPTT classique
+                    outputs_info=[T.zeros(shape), T.zeros(shape)]  # h_prev, c_prev
+                )
+        return x
+
     def model_layers_predict(self, x, *args):
         """
         Définie le model pour toutes les couches
@@ -337,7 +412,11 @@ class LSTMGraph:
         if self.layers[num_layer]['params']['activation_function'] == 'tanh':
             return T.tanh(T.dot(x, self.layers[num_layer]['weights']['W']) + self.layers[num_layer]['biases']['b'])
         elif self.layers[num_layer]['params']['activation_function'] == 'softmax':
-            return T.nnet.softmax(T.dot(x, self.layers[num_layer]['weights']['W']) + self.layers[num_layer]['biases']['b'])[0]
+            out = T.dot(x, self.layers[num_layer]['weights']['W']) + self.layers[num_layer]['biases']['b']
+            if x.ndim == 3:  # softmax ne prend que des matrices
+                return T.nnet.softmax(out.reshape((-1, out.shape[2]))).reshape(out.shape)
+            out = T.nnet.softmax(out)
+            return out[0] if x.ndim == 1 else out  # softmax rend une matrice
         return T.nnet.sigmoid(T.dot(x, self.layers[num_layer]['weights']['W']) + self.layers[num_layer]['biases']['b'])
 
     def model_lstm_layer(self, x, h_prev, c_prev, num_layer):
@@ -348,20 +427,43 @@ class LSTMGraph:
         :param c_prev: mémoire de la couche au temps précédent
         :return: memoire de cette couche, sortie de cette couche, sortie du reseau
         """
+        # un seul produit pour les 4 portes
+        gates = T.dot(x, self.layers[num_layer]['weights']['W']) + T.dot(h_prev, self.layers[num_layer]['weights']['U']) + self.layers[num_layer]['biases']['b']
+        return self.model_lstm_gates(gates, c_prev, num_layer)
+
+    def model_lstm_step(self, xw, h_prev, c_prev, num_layer):
+        """
+        Un pas de temps d'une couche LSTM dont la projection de l'entrée est déjà calculée
+        :param xw: projection de l'entrée, x·W + b
+        :param h_prev: sortie de la couche au temps précédent
+        :param c_prev: mémoire de la couche au temps précédent
+        :return: sortie, mémoire
+        """
+        gates = xw + T.dot(h_prev, self.layers[num_layer]['weights']['U'])
+        return self.model_lstm_gates(gates, c_prev, num_layer)
+
+    def model_lstm_gates(self, gates, c_prev, num_layer):
+        """
+        Calcul des portes, de la mémoire et de la sortie d'une couche LSTM
+        :param gates: produit des entrées et sorties précédentes par les poids regroupés
+        :param c_prev: mémoire de la couche au temps précédent
+        :return: sortie, mémoire
+        """
+        length = self.layers[num_layer]['length']
         # Forget gate
-        f = T.nnet.sigmoid(T.dot(x, self.layers[num_layer]['weights']['Wf']) + T.dot(h_prev, self.layers[num_layer]['weights']['Uf']) + self.layers[num_layer]['biases']['bf'])
+        f = T.nnet.sigmoid(self.gate(gates, 0, length))
         # Input gate
-        i = T.nnet.sigmoid(T.dot(x, self.layers[num_layer]['weights']['Wi']) + T.dot(h_prev, self.layers[num_layer]['weights']['Ui']) + self.layers[num_layer]['biases']['bi'])
+        i = T.nnet.sigmoid(self.gate(gates, 1, length))
         # Output gate
-        o = T.nnet.sigmoid(T.dot(x, self.layers[num_layer]['weights']['Wo']) + T.dot(h_prev, self.layers[num_layer]['weights']['Uo']) + self.layers[num_layer]['biases']['bo'])
+        o = T.nnet.sigmoid(self.gate(gates, 2, length))
         # Mémoire
-        c = f * c_prev + i * T.tanh(T.dot(x, self.layers[num_layer]['weights']['Wc']) + T.dot(h_prev, self.layers[num_layer]['weights']['Uc']) + self.layers[num_layer]['biases']['bc'])
+        c = f * c_prev + i * T.tanh(self.gate(gates, 3, length))
         h = o * T.tanh(c)
         return h, c
 
     def get_weights(self):
         """
-        Récupère les poids en cours
+        Récupère les poids en cours (par porte pour les couches LSTM)
         """
         layers = []
         for layer in self.layers:
@@ -376,26 +478,15 @@ class LSTMGraph:
                 layers[-1]['weights'][w] = val.get_value()
             for w, val in layer['biases'].items():
                 layers[-1]['biases'][w] = val.get_value()
+            if layer['type'] == 'lstm':
+                layers[-1]['weights'], layers[-1]['biases'] = self.split_lstm_weights(layers[-1]['weights'], layers[-1]['biases'])
         return layers
 
     def save_weights(self, file):
         """
         Sauvegarde les poids dans un fichiers
         """
-        layers = []
-        for layer in self.layers:
-            layers.append({
-                'length': layer['length'],
-                'weights': {},
-                'biases': {},
-                'type': layer['type'],
-                'params': layer['params']
-            })
-            for w, val in layer['weights'].items():
-                layers[-1]['weights'][w] = val.get_value()
-            for w, val in layer['biases'].items():
-                layers[-1]['biases'][w] = val.get_value()
-        pickle.dump(layers, open(file, 'ab'))
+        pickle.dump(self.get_weights(), open(file, 'ab'))
         return self
 
     def load_weights(self, file):
@@ -438,14 +529,6 @@ class LSTMGraph:
         self.nb_inputs = size
         return self
 
-    def set_print_callback(self, fn):
-        """
-        Change printing callback in theano
-        :param fn: function to use fn(op, xin)
-        """
-        self.print_callback = fn
-        return self
-
     def set_predict_stopping_condition(self, fn):
         """
         Change theano stopping condition
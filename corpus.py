@@ -0,0 +1,195 @@
+# coding: utf-8
+"""
+Compilation d'un dossier de fichiers midi en un corpus : les tableaux de
+tous les morceaux sont mis bout à bout dans quelques gros fichiers (shards)
+lus en mémoire mappée, avec un index des morceaux.
+
+usage : python corpus.py [source] [destination] [--step 10] [--limit -1] ...
+"""
+import argparse
+import json
+import os
+import numpy as np
+import file
+
+
+def find_files(source='musics/format 0'):
+    """
+    Liste les fichiers de chaque artiste du dossier source (source/<artiste>/)
+    :return: liste de couples (artiste, chemin relatif à source)
+    """
+    found = []
+    for artist in sorted(os.listdir(source)):
+        if not os.path.isdir(os.path.join(source, artist)):
+            continue
+        for name in sorted(os.listdir(os.path.join(source, artist))):
+            if os.path.isfile(os.path.join(source, artist, name)):
+                found.append((artist, artist + '/' + name))
+    return found
+
+
+def compile_corpus(source, destination, encoder, shardSize=256, workers=None):
+    """
+    Encode tous les fichiers de source et les écrit dans destination :
+    des fichiers shard_<n>.f32 (lignes float32 des tableaux à la suite,
+    ou shard_<n>.u8 avec les lignes des PackedRoll si l'encodeur est packed)
+    et un fichier index.json qui donne, pour chaque morceau, son shard,
+    sa première ligne, son nombre de lignes, son artiste, son chemin, et la
+    date et la taille du fichier midi encodé
+    :param encoder: RollEncoder (tableaux complets ou compactés) à utiliser
+    :param shardSize: taille maximale d'un shard (Mo), un morceau n'est jamais
+                      coupé entre deux shards
+    :param workers: nombre de processus pour l'encodage
+    """
+    os.makedirs(destination, exist_ok=True)
+    # l'ancien index est supprimé avant de toucher aux shards : un corpus
+    # dont la compilation est interrompue n'est pas lisible
+    if os.path.exists(os.path.join(destination, 'index.json')):
+        os.remove(os.path.join(destination, 'index.json'))
+    for name in os.listdir(destination):
+        if name.startswith('shard_'):
+            os.remove(os.path.join(destination, name))
+    files = find_files(source)
+    # date et taille avant l'encodage, un fichier modifié pendant la compilation sera périmé
+    stats = dict((path, os.stat(os.path.join(source, path))) for _, path in files)
+    artists = dict((path, artist) for artist, path in files)
+    if encoder.packed:
+        rowSize, ext = (encoder.nbPitches + 7)//8 + 2, 'u8'
+    else:
+        rowSize, ext = (encoder.nbPitches + 3)*4, 'f32'
+    index = {'config': list(encoder.config()), 'columns': encoder.nbPitches + 3,
+             'packed': encoder.packed, 'source': source, 'shards': [], 'pieces': []}
+    shard = None
+    try:
+        loaded = file.load_files([os.path.join(source, path) for _, path in files], encoder, workers)
+        for (_, path), (_, timeline) in zip(files, loaded):
+            if encoder.packed:
+                timeline = np.ascontiguousarray(timeline.data)
+            else:
+                timeline = np.ascontiguousarray(timeline, dtype=np.float32)
+            # nouveau shard si le morceau ne tient pas dans le shard courant
+            if shard is None or (shard.tell() > 0 and shard.tell() + timeline.nbytes > shardSize*2**20):
+                if shard is not None:
+                    shard.close()
+                index['shards'].append('shard_{:03d}.{}'.format(len(index['shards']), ext))
+                shard = open(os.path.join(destination, index['shards'][-1]), 'wb')
+            index['pieces'].append({'shard': len(index['shards']) - 1, 'offset': shard.tell()//rowSize,
+                                    'length': len(timeline), 'artist': artists[path], 'path': path,
+                                    'mtime': stats[path].st_mtime_ns, 'size': stats[path].st_size})
+            shard.write(timeline.data)
+    finally:
+        if shard is not None:
+            shard.close()
+    # l'index est écrit en dernier : un corpus incomplet n'est pas lisible
+    with open(os.path.join(destination, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+    return Corpus(destination)
+
+
+class Corpus:
+    """
+    Lecture d'un corpus compilé : les morceaux sont des vues (sans copie)
+    sur les shards ouverts avec np.memmap (des PackedRoll pour un corpus compacté)
+    """
+
+    def __init__(self, directory='data/corpus'):
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json')) as f:
+            index = json.load(f)
+        self.config = tuple(index['config'])
+        self.columns = index['columns']
+        self.source = index.get('source')
+        self.packed = index.get('packed', False)
+        nbPitches = self.columns - 3
+        if self.packed:
+            rowSize, dtype = (nbPitches + 7)//8 + 2, np.uint8
+        else:
+            rowSize, dtype = self.columns*4, np.float32
+        self.pieces = index['pieces']
+        self.paths = dict((piece['path'], n) for n, piece in enumerate(self.pieces))
+        self.shards = []
+        for name in index['shards']:
+            path = os.path.join(directory, name)
+            rows = os.path.getsize(path)//rowSize
+            if rows == 0:
+                # np.memmap refuse les fichiers vides
+                self.shards.append(np.zeros((0, rowSize//dtype().itemsize), dtype=dtype))
+            else:
+                self.shards.append(np.memmap(path, dtype=dtype, mode='r', shape=(rows, rowSize//dtype().itemsize)))
+
+    @classmethod
+    def open_for(cls, encoder, directory='data/corpus'):
+        """
+        Ouvre le corpus du dossier s'il existe et a été compilé avec les mêmes
+        paramètres que l'encodeur, sinon renvoie None. Les morceaux dont le
+        fichier midi a changé depuis la compilation sont retirés du corpus
+        """
+        if not os.path.exists(os.path.join(directory, 'index.json')):
+            return None
+        corpus = cls(directory)
+        if corpus.config != tuple(encoder.config()):
+            return None
+        stale = [path for path in corpus.paths if not corpus.fresh(path)]
+        for path in stale:
+            print('File', path, 'changed since the corpus was compiled.')
+        if stale:
+            # renumérotés, les morceaux périmés ne sont plus accessibles par numéro
+            corpus.pieces = [piece for piece in corpus.pieces if piece['path'] not in stale]
+            corpus.paths = dict((piece['path'], n) for n, piece in enumerate(corpus.pieces))
+        return corpus
+
+    def fresh(self, path):
+        """
+        Vrai si le fichier midi du morceau n'a pas changé (date et taille)
+        depuis la compilation
+        """
+        piece = self.pieces[self.paths[path]]
+        if self.source is None or 'mtime' not in piece:
+            return False
+        try:
+            stat = os.stat(os.path.join(self.source, path))
+        except OSError:
+            return False
+        return (stat.st_mtime_ns, stat.st_size) == (piece['mtime'], piece['size'])
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def __getitem__(self, n):
+        """
+        Tableau du morceau n (ou de chemin n)
+        """
+        if isinstance(n, str):
+            n = self.paths[n]
+        piece = self.pieces[n]
+        rows = self.shards[piece['shard']][piece['offset']:piece['offset'] + piece['length']]
+        if self.packed:
+            # velocityScale est dans la configuration de l'encodeur
+            return file.PackedRoll(self.columns - 3, rows, self.config[4])
+        return rows
+
+    def artist(self, artist):
+        """
+        Numéros des morceaux d'un artiste
+        """
+        return [n for n, piece in enumerate(self.pieces) if piece['artist'] == artist]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile un dossier de fichiers midi en corpus')
+    parser.add_argument('source', nargs='?', default='musics/format 0', help='dossier des artistes')
+    parser.add_argument('destination', nargs='?', default='data/corpus', help='dossier du corpus')
+    parser.add_argument('--step', type=int, default=10, help='pas de quantification (ms)')
+    parser.add_argument('--limit', type=int, default=-1, help='durée maximale des morceaux (ms)')
+    parser.add_argument('--pitches', type=int, default=36, help='nombre de colonnes de notes')
+    parser.add_argument('--no-fold', dest='fold', action='store_false', help='ne replie pas les hauteurs')
+    parser.add_argument('--packed', action='store_true', help='shards compactés (PackedRoll)')
+    parser.add_argument('--shard-size', type=int, default=256, help='taille maximale des shards (Mo)')
+    parser.add_argument('--workers', type=int, default=None, help='nombre de processus')
+    args = parser.parse_args()
+    encoder = file.RollEncoder(args.pitches, fold=args.fold, step=args.step, timeLimit=args.limit, packed=args.packed)
+    corpus = compile_corpus(args.source, args.destination, encoder, args.shard_size, args.workers)
+    print(len(corpus), 'pieces in', len(corpus.shards), 'shards written to', args.destination)
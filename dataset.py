@@ -0,0 +1,130 @@
+# coding: utf-8
+"""
+Découpage des morceaux encodés (file.RollEncoder) en fenêtres de longueur
+fixe pour l'entrainement, sans copie, et regroupement des fenêtres de
+longueurs proches pour former des lots.
+"""
+import random
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import file
+
+
+def windows(timeline, length, stride=None, minLength=2):
+    """
+    Découpe un morceau en fenêtres de <length> étapes
+    :param timeline: tableau (étapes x colonnes), ou file.WindowedRoll
+                     (SparseRoll, PackedRoll...) dont les fenêtres sont
+                     converties en tableaux complets une à une
+    :param stride: décalage entre deux fenêtres (défaut length, sans recouvrement),
+                   plus petit que length pour des fenêtres qui se recouvrent
+    :param minLength: longueur minimale de la dernière fenêtre
+    :return: (full, tail), full la vue (fenêtres x length x colonnes) des
+             fenêtres complètes sur le tableau (des Windows pour un
+             WindowedRoll), tail la fenêtre suivante, plus courte que length,
+             si des étapes ne sont dans aucune fenêtre complète (None sinon,
+             ou si moins de minLength étapes)
+    """
+    stride = stride or length
+    if isinstance(timeline, file.WindowedRoll):
+        full = Windows(timeline, length, stride)
+    elif len(timeline) < length:
+        timeline = np.asarray(timeline)
+        full = np.empty((0, length) + timeline.shape[1:], dtype=timeline.dtype)
+    else:
+        timeline = np.asarray(timeline)
+        # vue (fenêtres x colonnes x length), remise en (fenêtres x length x colonnes)
+        full = sliding_window_view(timeline, length, axis=0)[::stride].transpose(0, 2, 1)
+    # la fenêtre suivante, trop courte, seulement si des étapes restent
+    # après la dernière fenêtre complète
+    tail = None
+    if len(full) == 0 or (len(full) - 1)*stride + length < len(timeline):
+        tail = timeline[len(full)*stride:]
+        if len(tail) < minLength:
+            tail = None
+    return full, tail
+
+
+class Windows:
+    """
+    Fenêtres complètes d'un file.WindowedRoll, converties en tableaux
+    complets (length x colonnes) au moment où on les lit
+    """
+
+    def __init__(self, roll, length, stride):
+        self.roll = roll
+        self.length = length
+        self.stride = stride
+
+    def __len__(self):
+        return max(0, (len(self.roll) - self.length)//self.stride + 1)
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError(n)
+        return self.roll[n*self.stride:n*self.stride + self.length]
+
+
+class WindowDataset:
+    """
+    Ensemble de fenêtres de plusieurs morceaux, rangées par longueur : les
+    fenêtres complètes ont toutes <length> étapes, les fins de morceaux sont
+    rangées dans des paquets de longueur arrondie au multiple de bucketWidth
+    supérieur, pour que les fenêtres d'un même lot aient des longueurs proches
+    """
+
+    def __init__(self, length=200, stride=None, bucketWidth=None, minLength=2):
+        """
+        :param length: longueur des fenêtres (étapes)
+        :param stride: décalage entre deux fenêtres (défaut length)
+        :param bucketWidth: écart de longueur maximal dans un paquet (défaut length/4)
+        :param minLength: longueur minimale d'une fenêtre
+        """
+        self.length = length
+        self.stride = stride or length
+        self.bucketWidth = bucketWidth or max(1, length//4)
+        self.minLength = minLength
+        # longueur du paquet -> liste de (nom, vue de fenêtres (n x longueur x colonnes))
+        self.buckets = {}
+
+    def add(self, name, timeline):
+        """
+        Ajoute les fenêtres d'un morceau
+        """
+        full, tail = windows(timeline, self.length, self.stride, self.minLength)
+        if len(full) > 0:
+            self.buckets.setdefault(self.length, []).append((name, full))
+        if tail is not None:
+            bucket = min(-(-len(tail)//self.bucketWidth)*self.bucketWidth, self.length)
+            self.buckets.setdefault(bucket, []).append((name, tail[np.newaxis]))
+
+    def __len__(self):
+        return sum(len(w) for group in self.buckets.values() for _, w in group)
+
+    def __iter__(self):
+        """
+        Toutes les fenêtres (tableaux étapes x colonnes), paquet par paquet
+        """
+        for bucket in sorted(self.buckets):
+            for _, group in self.buckets[bucket]:
+                yield from group
+
+    def batches(self, batchSize, shuffle=True):
+        """
+        Lots d'au plus batchSize fenêtres d'un même paquet
+        :param shuffle: mélange les fenêtres de chaque paquet et l'ordre des lots
+        :return: liste de listes de fenêtres (tableaux étapes x colonnes)
+        """
+        batches = []
+        for bucket in sorted(self.buckets):
+            # indices (morceau, fenêtre) pour ne pas copier les vues
+            index = [(g, n) for g, (_, group) in enumerate(self.buckets[bucket]) for n in range(len(group))]
+            if shuffle:
+                random.shuffle(index)
+            for start in range(0, len(index), batchSize):
+                batches.append([self.buckets[bucket][g][1][n] for g, n in index[start:start + batchSize]])
+        if shuffle:
+            random.shuffle(batches)
+        return batches
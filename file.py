@@ -1,5 +1,445 @@
 import midi
 import numpy as np
+import os
+import hashlib
+import collections
+import concurrent.futures
+
+
+class RollEncoder:
+    """
+    Conversion des fichiers midi en tableaux échantillonnés : une ligne par
+    étape de <step> ms, une colonne par hauteur de note jouée, puis la vitesse
+    moyenne des notes, le signal de début et le signal de fin
+    """
+    # à incrémenter à chaque changement du format des tableaux produits,
+    # pour invalider les tableaux en cache (voir RollCache)
+    version = 1
+
+    def __init__(self, nbPitches=128, lowestPitch=0, fold=False, velocityScale=None, step=10, timeLimit=-1, sparse=False, packed=False):
+        """
+        :param nbPitches: nombre de colonnes de notes
+        :param lowestPitch: hauteur de la première colonne
+        :param fold: replie les hauteurs modulo nbPitches, sinon les notes
+                     hors de [lowestPitch, lowestPitch+nbPitches[ sont ignorées
+        :param velocityScale: diviseur de la vitesse (défaut nbPitches)
+        :param step: pas de quantification de la musique (ms)
+        :param timeLimit: temps total limite de la musique (ms)
+                          ignoré si négatif
+        :param sparse: produit des SparseRoll au lieu de tableaux numpy
+        :param packed: produit des PackedRoll au lieu de tableaux numpy
+        """
+        self.nbPitches = nbPitches
+        self.lowestPitch = lowestPitch
+        self.fold = fold
+        self.velocityScale = velocityScale or nbPitches
+        self.step = step
+        self.timeLimit = timeLimit
+        self.sparse = sparse
+        self.packed = packed
+
+    def config(self):
+        """
+        Paramètres qui déterminent le tableau produit pour un fichier
+        """
+        return (self.version, self.nbPitches, self.lowestPitch, self.fold,
+                self.velocityScale, self.step, self.timeLimit)
+
+    def encode(self, name):
+        """
+        Charge un fichier, et le converti en tableau de notes échantillonées
+        """
+        # seule la première piste est lue, sous forme de tableaux
+        m = midi.MidiFile(lazy=True, compact=True)
+        m.open(name, mapped=True)
+        m.read()
+        track = m.tracks[0]
+        m.close()
+        timeline = self.encode_notes(track.notes(), m.tempoMap())
+        print('File', name, 'of length:', len(timeline), 'loaded.')
+        return timeline
+
+    def encode_notes(self, notes, tempoMap):
+        """
+        Converti des notes (midi.Notes) en tableau de notes échantillonées
+        :param tempoMap: midi.TempoMap du fichier des notes
+        """
+        # conversion en notes jouées toutes les <step> ms
+        columns = notes.pitch - self.lowestPitch
+        if self.fold:
+            columns = columns % self.nbPitches
+        inRange = (columns >= 0) & (columns < self.nbPitches)
+        onsets = tempoMap.toFrames(notes.onset[inRange], self.step)
+        offsets = tempoMap.toFrames(notes.offset[inRange], self.step)
+        playing, velocity = self.rasterize(onsets, offsets, columns[inRange], notes.velocity[inRange])
+        if self.sparse:
+            return SparseRoll.from_playing(playing, velocity)
+        if self.packed:
+            return PackedRoll.from_playing(playing, velocity, self.velocityScale)
+        # tableau complet
+        timeline = np.zeros((len(velocity), self.nbPitches + 3), dtype=np.float32)
+        timeline[:, :self.nbPitches] = (playing > 0).T
+        timeline[:, self.nbPitches] = velocity
+        timeline[0, self.nbPitches + 1] = 1
+        timeline[-1, self.nbPitches + 2] = 1
+        return timeline
+
+    def transpose(self, timeline, semitones):
+        """
+        Vue transposée de <semitones> demi-tons d'un tableau produit par cet
+        encodeur, voir Transposed
+        """
+        return Transposed(timeline, semitones, self.fold)
+
+    def rasterize(self, onsets, offsets, columns, velocities):
+        """
+        Calcule les notes jouées à chaque étape à partir des étapes de début
+        et de fin (exclue), de la colonne et de la vitesse de chaque note
+        :return: (playing, velocity), le nombre de notes jouées par colonne
+                 et par étape (colonnes x étapes), et la vitesse moyenne par étape
+                 (avec une étape vide de plus de chaque côté pour les signaux
+                 de début et fin)
+        """
+        lengths = np.maximum(offsets - onsets, 0)
+        total = int(lengths.sum())
+        # les étapes vides au début et à la fin sont enlevées : la première ligne
+        # est le début de la première note, la dernière la fin de la dernière
+        nbFrames = 0
+        if total > 0:
+            first = onsets[lengths > 0].min()
+            nbFrames = offsets[lengths > 0].max() - first
+        if self.timeLimit >= 0:
+            # trim les étapes jusqu'à la limite de temps
+            nbFrames = min(nbFrames, int(self.timeLimit/self.step))
+        # une étape de plus de chaque côté pour les signaux de début et fin
+        # (une ligne par colonne pour que la somme cumulée soit contiguë)
+        playing = np.zeros((self.nbPitches, nbFrames + 2), dtype=np.int16)
+        velocity = np.zeros(nbFrames + 2, dtype=np.float32)
+        if total == 0:
+            return playing, velocity
+
+        # lignes de début et de fin (exclue) de chaque note : on compte les notes
+        # jouées par case avec des différences cumulées, sans parcourir les notes
+        keep = lengths > 0
+        starts = np.minimum(onsets[keep] - first + 1, nbFrames + 1)
+        ends = np.minimum(offsets[keep] - first + 1, nbFrames + 1)
+        columns, velocities = columns[keep], velocities[keep]
+        np.add.at(playing, (columns, starts), 1)
+        np.add.at(playing, (columns, ends), -1)
+        np.cumsum(playing, axis=1, out=playing)
+        # moyennage de la vitesse des notes de chaque étape
+        count = np.cumsum(np.bincount(starts, minlength=nbFrames + 2) - np.bincount(ends, minlength=nbFrames + 2))
+        vel = np.cumsum(np.bincount(starts, weights=velocities, minlength=nbFrames + 2)
+                        - np.bincount(ends, weights=velocities, minlength=nbFrames + 2))
+        notEmpty = count > 0
+        velocity[notEmpty] = vel[notEmpty]/count[notEmpty]/self.velocityScale
+        return playing, velocity
+
+
+class WindowedRoll:
+    """
+    Tableau échantillonné gardé sous une autre forme (SparseRoll, PackedRoll,
+    Transposed), converti en tableau complet par dense(start, stop) : roll[a:b]
+    en donne une fenêtre, et np.asarray(roll) le tableau entier
+    """
+    def dense(self, start=0, stop=None):
+        """
+        Tableau complet (float32) des étapes start à stop (exclue)
+        """
+        raise NotImplementedError
+
+    def __getitem__(self, item):
+        if isinstance(item, slice) and item.step in (None, 1):
+            return self.dense(item.start, item.stop)
+        return self.dense()[item]
+
+    def __array__(self, dtype=None, copy=None):
+        window = self.dense()
+        return window if dtype is None else window.astype(dtype)
+
+
+class SparseRoll(WindowedRoll):
+    """
+    Tableau échantillonné creux : les colonnes binaires (notes jouées,
+    signaux de début et fin) sont gardées au format CSR, la vitesse dans
+    une colonne complète
+    """
+    def __init__(self, nbPitches, indptr, indices, velocity):
+        """
+        :param indptr: les colonnes à 1 de l'étape n sont indices[indptr[n]:indptr[n+1]]
+        :param indices: colonnes à 1
+        :param velocity: vitesse de chaque étape
+        """
+        self.nbPitches = nbPitches
+        self.indptr = indptr
+        self.indices = indices
+        self.velocity = velocity
+
+    @classmethod
+    def from_playing(cls, playing, velocity):
+        """
+        Construit le tableau à partir des résultats de RollEncoder.rasterize
+        """
+        nbPitches, nbFrames = playing.shape
+        frames, columns = np.nonzero(playing.T > 0)
+        # signaux de début et fin
+        frames = np.concatenate([[0], frames, [nbFrames - 1]])
+        columns = np.concatenate([[nbPitches + 1], columns, [nbPitches + 2]])
+        indptr = np.zeros(nbFrames + 1, dtype=np.int64)
+        np.cumsum(np.bincount(frames, minlength=nbFrames), out=indptr[1:])
+        return cls(nbPitches, indptr, columns.astype(np.uint8), velocity)
+
+    @classmethod
+    def from_dense(cls, timeline, nbPitches):
+        """
+        Construit le tableau creux d'un tableau complet
+        """
+        timeline = np.asarray(timeline)
+        frames, columns = np.nonzero(np.delete(timeline, nbPitches, axis=1))
+        columns[columns >= nbPitches] += 1  # saute la colonne de vitesse
+        indptr = np.zeros(len(timeline) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(frames, minlength=len(timeline)), out=indptr[1:])
+        return cls(nbPitches, indptr, columns.astype(np.uint8), timeline[:, nbPitches].astype(np.float32))
+
+    def __len__(self):
+        return len(self.velocity)
+
+    @property
+    def shape(self):
+        return (len(self), self.nbPitches + 3)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.velocity.nbytes
+
+    def dense(self, start=0, stop=None):
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        window = np.zeros((stop - start, self.nbPitches + 3), dtype=np.float32)
+        a, b = self.indptr[start], self.indptr[stop]
+        rows = np.repeat(np.arange(stop - start), np.diff(self.indptr[start:stop+1]))
+        window[rows, self.indices[a:b]] = 1
+        window[:, self.nbPitches] = self.velocity[start:stop]
+        return window
+
+
+class PackedRoll(WindowedRoll):
+    """
+    Tableau échantillonné compacté : une ligne d'octets par étape, avec les
+    colonnes de notes regroupées par 8 bits (np.packbits), la vitesse
+    quantifiée sur un octet et un octet pour les signaux de début (bit 0)
+    et de fin (bit 1)
+    """
+    def __init__(self, nbPitches, data, velocityScale):
+        """
+        :param data: tableau uint8 (étapes x (nbPitches+7)//8 + 2)
+        :param velocityScale: diviseur de la vitesse du tableau complet,
+                              la vitesse est gardée multipliée par velocityScale
+        """
+        self.nbPitches = nbPitches
+        self.data = data
+        self.velocityScale = velocityScale
+        self.nbBytes = (nbPitches + 7)//8
+
+    @classmethod
+    def from_playing(cls, playing, velocity, velocityScale):
+        """
+        Construit le tableau à partir des résultats de RollEncoder.rasterize
+        """
+        nbPitches, nbFrames = playing.shape
+        nbBytes = (nbPitches + 7)//8
+        data = np.zeros((nbFrames, nbBytes + 2), dtype=np.uint8)
+        data[:, :nbBytes] = np.packbits(playing.T > 0, axis=1)
+        data[:, nbBytes] = np.clip(np.rint(velocity*velocityScale), 0, 255)
+        data[0, nbBytes + 1] |= 1
+        data[-1, nbBytes + 1] |= 2
+        return cls(nbPitches, data, velocityScale)
+
+    @classmethod
+    def from_dense(cls, timeline, nbPitches, velocityScale):
+        """
+        Construit le tableau compacté d'un tableau complet
+        """
+        timeline = np.asarray(timeline)
+        nbBytes = (nbPitches + 7)//8
+        data = np.zeros((len(timeline), nbBytes + 2), dtype=np.uint8)
+        data[:, :nbBytes] = np.packbits(timeline[:, :nbPitches] > 0.5, axis=1)
+        data[:, nbBytes] = np.clip(np.rint(timeline[:, nbPitches]*velocityScale), 0, 255)
+        data[:, nbBytes + 1] = (timeline[:, nbPitches + 1] > 0.5) | ((timeline[:, nbPitches + 2] > 0.5) << 1)
+        return cls(nbPitches, data, velocityScale)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def shape(self):
+        return (len(self), self.nbPitches + 3)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def dense(self, start=0, stop=None):
+        rows = self.data[start:stop]
+        window = np.empty((len(rows), self.nbPitches + 3), dtype=np.float32)
+        window[:, :self.nbPitches] = np.unpackbits(rows[:, :self.nbBytes], axis=1, count=self.nbPitches)
+        window[:, self.nbPitches] = rows[:, self.nbBytes]
+        window[:, self.nbPitches] /= self.velocityScale
+        window[:, self.nbPitches + 1] = rows[:, self.nbBytes + 1] & 1
+        window[:, self.nbPitches + 2] = rows[:, self.nbBytes + 1] >> 1
+        return window
+
+
+class RollCache:
+    """
+    Cache sur disque des tableaux d'un RollEncoder, adressé par le contenu :
+    la clé est le hash du fichier midi et des paramètres de l'encodeur.
+    Les tableaux sont gardés en .npy et relus en mémoire mappée (un .npy
+    par tableau du CSR pour les SparseRoll). S'utilise à la place de l'encodeur
+    (RollCache(encoder).encode(name)), ou avec load_files(..., cache=...)
+    """
+
+    def __init__(self, encoder, directory='data/cache'):
+        """
+        :param encoder: RollEncoder pour les fichiers absents du cache
+        :param directory: dossier du cache
+        """
+        self.encoder = encoder
+        self.directory = directory
+        # hash des fichiers déjà lus, recalculé si la date ou la taille change
+        self.hashes = {}
+
+    def hash(self, name):
+        """
+        Hash du contenu d'un fichier
+        """
+        stat = os.stat(name)
+        known = self.hashes.get(name)
+        if known is not None and known[0] == (stat.st_mtime_ns, stat.st_size):
+            return known[1]
+        digest = hashlib.sha1()
+        with open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        self.hashes[name] = ((stat.st_mtime_ns, stat.st_size), digest)
+        return digest
+
+    def path(self, name):
+        """
+        Chemin (sans extension) du tableau en cache d'un fichier
+        """
+        config = (self.encoder.config(), self.encoder.sparse, self.encoder.packed)
+        key = hashlib.sha1((self.hash(name) + repr(config)).encode()).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def lookup(self, name):
+        """
+        Cherche le tableau d'un fichier dans le cache
+        :return: (chemin dans le cache, tableau ou None s'il est absent)
+        """
+        path = self.path(name)
+        timeline = self.load(path)
+        if timeline is not None:
+            print('File', name, 'of length:', len(timeline), 'loaded from cache.')
+        return path, timeline
+
+    def encode(self, name):
+        """
+        Charge le tableau d'un fichier depuis le cache, ou l'encode et l'ajoute
+        """
+        path, timeline = self.lookup(name)
+        if timeline is not None:
+            return timeline
+        timeline = self.encoder.encode(name)
+        self.store(path, timeline)
+        return timeline
+
+    def load(self, path):
+        """
+        Lit un tableau du cache, None s'il est absent
+        """
+        if self.encoder.sparse:
+            # velocity est écrit en dernier, les autres tableaux sont alors complets
+            if not os.path.exists(path + '.velocity.npy'):
+                return None
+            arrays = [np.load('{}.{}.npy'.format(path, part), mmap_mode='r') for part in ('indptr', 'indices', 'velocity')]
+            return SparseRoll(self.encoder.nbPitches, *arrays)
+        if not os.path.exists(path + '.npy'):
+            return None
+        if self.encoder.packed:
+            return PackedRoll(self.encoder.nbPitches, np.load(path + '.npy', mmap_mode='r'), self.encoder.velocityScale)
+        return np.load(path + '.npy', mmap_mode='r')
+
+    def store(self, path, timeline):
+        """
+        Écrit un tableau dans le cache
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        # écriture dans un fichier temporaire renommé ensuite, pour que les
+        # processus qui lisent le cache en même temps ne voient pas de fichier partiel
+        if self.encoder.sparse:
+            parts = [('.indptr', timeline.indptr), ('.indices', timeline.indices), ('.velocity', timeline.velocity)]
+        elif self.encoder.packed:
+            parts = [('', timeline.data)]
+        else:
+            parts = [('', timeline)]
+        for part, array in parts:
+            tmp = '{}{}.{}.tmp.npy'.format(path, part, os.getpid())
+            np.save(tmp, array)
+            os.replace(tmp, path + part + '.npy')
+
+
+def transpose(timeline, semitones, fold=False):
+    """
+    Transpose un tableau échantillonné complet en décalant ses colonnes de notes
+    :param semitones: décalage (demi-tons), positif vers l'aigu
+    :param fold: hauteurs repliées (load_file_mod) : les colonnes sont décalées
+                 en boucle, sinon les notes qui sortent du tableau sont perdues
+    :return: nouveau tableau, la vitesse et les signaux sont inchangés
+    """
+    timeline = np.asarray(timeline)
+    nbPitches = timeline.shape[1] - 3
+    out = np.empty_like(timeline)
+    out[:, nbPitches:] = timeline[:, nbPitches:]
+    if fold:
+        shift = semitones % nbPitches
+        out[:, shift:nbPitches] = timeline[:, :nbPitches - shift]
+        out[:, :shift] = timeline[:, nbPitches - shift:nbPitches]
+    elif semitones >= 0:
+        shift = min(semitones, nbPitches)
+        out[:, :shift] = 0
+        out[:, shift:nbPitches] = timeline[:, :nbPitches - shift]
+    else:
+        shift = min(-semitones, nbPitches)
+        out[:, nbPitches - shift:nbPitches] = 0
+        out[:, :nbPitches - shift] = timeline[:, shift:nbPitches]
+    return out
+
+
+class Transposed(WindowedRoll):
+    """
+    Vue transposée d'un tableau échantillonné (tableau numpy, SparseRoll,
+    PackedRoll) : rien n'est copié, chaque fenêtre est transposée par dense
+    """
+    def __init__(self, roll, semitones, fold=False):
+        """
+        :param semitones: décalage (demi-tons), positif vers l'aigu
+        :param fold: hauteurs repliées, voir transpose
+        """
+        self.roll = roll
+        self.semitones = semitones
+        self.fold = fold
+
+    def __len__(self):
+        return len(self.roll)
+
+    @property
+    def shape(self):
+        return self.roll.shape
+
+    def dense(self, start=0, stop=None):
+        return transpose(self.roll[start:stop], self.semitones, self.fold)
 
 
 def loadFile(name, step=10, timeLimit=-1):
@@ -9,146 +449,68 @@ def loadFile(name, step=10, timeLimit=-1):
     :param timeLimit: temps total limite de la musique (ms)
                       ignoré si négatif
     """
-    m = midi.MidiFile()
-    m.open(name)
-    m.read()
-    m.close()
-
-    # print(m.tracks[0])
-    # conversion en notes jouées toutes les <step> ms
-    noteTimeline = {}
-    currentNotes = {p: [-1, 0] for p in range(128)}
-    currentTempo = 500000
-    lastTempoTimeMicro = 0
-    lastTempoTimeTick = 0
-    for e in m.tracks[0].events:
-        if e.type == 'SET_TEMPO':  # changement de tempo dans la piste
-            t = (e.time-lastTempoTimeTick)*currentTempo/m.ticksPerQuarterNote + lastTempoTimeMicro # durée en µs
-            currentTempo = e.data
-            lastTempoTimeMicro = t
-            lastTempoTimeTick = e.time
-        elif e.type == 'NOTE_ON':  # début/fin d'une note
-            t = (e.time-lastTempoTimeTick)*currentTempo/m.ticksPerQuarterNote + lastTempoTimeMicro # durée en µs
-            n = int( t/(step*1000) )
-            if e.velocity != 0:
-                # début d'une note -> ajout aux notes actuelles
-                currentNotes[e.pitch] = [n, e.velocity]
-            else:
-                # fin d'une note: rempli le tableau de 1 depuis le début de cette note
-                if currentNotes[e.pitch][0] == -1:
-                    continue
-                for k in range(currentNotes[e.pitch][0], n):
-                    if k not in noteTimeline:
-                        noteTimeline[k] = []  # ajout de la clé de temps <k>
-                    vel = currentNotes[e.pitch][1]
-                    noteTimeline[k].append( (e.pitch, vel) )
-                currentNotes[e.pitch] = [-1, 0]
-                
-    # conversion en tableau des notes par étapes
-    timeline = [[0 for k in range(128 + 3)] for n in range(max(noteTimeline.keys())+2)]
-    print('File', name, 'of length:', len(timeline), 'loaded.')
-    for n in noteTimeline:
-        vel = 0
-        for p, v in noteTimeline[n]:
-            vel += v
-            timeline[n+1][p] = 1
-        timeline[n+1][128] = (vel/len(noteTimeline[n]))/128 # moyennage de la vitesse
-
-    # trim les étapes vides au début
-    while all(tm == 0 for tm in timeline[0]):
-        timeline.pop(0)
-    # trim les étapes selon la limite de temps
-    if timeLimit < 0:
-        # trim les étapes vides à la fin
-        while all(tm == 0 for tm in timeline[-1]):
-            timeline.pop()
-    else:
-        # trim les étapes jusqu'à la limite de temps
-        timeline = timeline[:int(timeLimit/step)]
-
-    # signaux de début et fin
-    timeline = [[1*(i==129) for i in range(128+3)]] + timeline + [[1*(i==130) for i in range(128+3)]]
-
-    # Test : added to try just with one note
-    # for t in range(len(timeline)):
-    #     found = False
-    #     for k in range(len(timeline[t])-4, -1, -1):  # We keep only the highest note
-    #         if timeline[t][k] == 1 and found:
-    #             timeline[t][k] = 0
-    #         elif timeline[t][k] == 1 and not found:
-    #             found = True
-    # print(timeline)
-    # End Test
-    return np.asarray(timeline)
+    return RollEncoder(128, step=step, timeLimit=timeLimit).encode(name)
 
 def load_file_mod(name, step=10, timeLimit=-1):
     """
-    Charge un fichier, et le converti en tableau de notes échantillonées
+    Charge un fichier, et le converti en tableau de notes échantillonées,
+    les hauteurs étant repliées sur 36 notes
     :param step: pas de quantification de la musique (ms)
     :param timeLimit: temps total limite de la musique (ms)
                       ignoré si négatif
     """
-    m = midi.MidiFile()
-    m.open(name)
-    m.read()
-    m.close()
-
-    # print(m.tracks[0])
-    # conversion en notes jouées toutes les <step> ms
-    noteTimeline = {}
-    currentNotes = {p: [-1, 0] for p in range(36)}
-    currentTempo = 500000
-    lastTempoTimeMicro = 0
-    lastTempoTimeTick = 0
-    for e in m.tracks[0].events:
-        pitch = e.pitch%36
-        if e.type == 'SET_TEMPO':  # changement de tempo dans la piste
-            t = (e.time-lastTempoTimeTick)*currentTempo/m.ticksPerQuarterNote + lastTempoTimeMicro # durée en µs
-            currentTempo = e.data
-            lastTempoTimeMicro = t
-            lastTempoTimeTick = e.time
-        elif e.type == 'NOTE_ON':  # début/fin d'une note
-            t = (e.time-lastTempoTimeTick)*currentTempo/m.ticksPerQuarterNote + lastTempoTimeMicro # durée en µs
-            n = int( t/(step*1000) )
-            if e.velocity != 0:
-                # début d'une note -> ajout aux notes actuelles
-                currentNotes[pitch] = [n, e.velocity]
-            else:
-                # fin d'une note: rempli le tableau de 1 depuis le début de cette note
-                if currentNotes[pitch][0] == -1:
-                    continue
-                for k in range(currentNotes[pitch][0], n):
-                    if k not in noteTimeline:
-                        noteTimeline[k] = []  # ajout de la clé de temps <k>
-                    vel = currentNotes[pitch][1]
-                    noteTimeline[k].append( (pitch, vel) )
-                currentNotes[pitch] = [-1, 0]
-                
-    # conversion en tableau des notes par étapes
-    timeline = [[0 for k in range(36 + 3)] for n in range(max(noteTimeline.keys())+2)]
-    print('File', name, 'of length:', len(timeline), 'loaded.')
-    for n in noteTimeline:
-        vel = 0
-        for p, v in noteTimeline[n]:
-            vel += v
-            timeline[n+1][p] = 1
-        timeline[n+1][36] = (vel/len(noteTimeline[n]))/36 # moyennage de la vitesse
-
-    # trim les étapes vides au début
-    while all(tm == 0 for tm in timeline[0]):
-        timeline.pop(0)
-    # trim les étapes selon la limite de temps
-    if timeLimit < 0:
-        # trim les étapes vides à la fin
-        while all(tm == 0 for tm in timeline[-1]):
-            timeline.pop()
-    else:
-        # trim les étapes jusqu'à la limite de temps
-        timeline = timeline[:int(timeLimit/step)]
+    return RollEncoder(36, fold=True, step=step, timeLimit=timeLimit).encode(name)
 
-    # signaux de début et fin
-    timeline = [[1*(i==37) for i in range(39)]] + timeline + [[1*(i==38) for i in range(39)]]
-    return np.asarray(timeline)
+def load_files(names, encoder, workers=None, ordered=True, cache=None):
+    """
+    Charge une liste de fichiers en parallèle dans un pool de processus
+    :param names: liste des fichiers à charger
+    :param encoder: RollEncoder à utiliser
+    :param workers: nombre de processus (défaut: nombre de coeurs)
+    :param ordered: rend les résultats dans l'ordre de names si vrai,
+                    sinon dès qu'ils sont prêts
+    :param cache: RollCache de l'encodeur : les fichiers en cache sont lus
+                  directement (en mémoire mappée), seuls les autres sont
+                  encodés dans le pool, puis ajoutés au cache
+    :return: générateur de couples (nom, tableau de notes)
+    """
+    workers = workers or os.cpu_count() or 1
+    # (nom, future, chemin dans le cache où ranger le résultat)
+    pending = collections.deque()
+    names = iter(names)
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        def submit():
+            # on garde au plus 2*workers fichiers en cours pour borner la mémoire
+            # (les fichiers lus du cache comptent aussi)
+            for name in names:
+                path, timeline = cache.lookup(name) if cache is not None else (None, None)
+                if timeline is not None:
+                    future = concurrent.futures.Future()
+                    future.set_result(timeline)
+                    pending.append((name, future, None))
+                else:
+                    pending.append((name, pool.submit(encoder.encode, name), path))
+                if len(pending) >= 2*workers:
+                    break
+        try:
+            submit()
+            while pending:
+                if ordered:
+                    name, future, path = pending.popleft()
+                else:
+                    done, _ = concurrent.futures.wait([p[1] for p in pending], return_when=concurrent.futures.FIRST_COMPLETED)
+                    entry = next(p for p in pending if p[1] in done)
+                    pending.remove(entry)
+                    name, future, path = entry
+                timeline = future.result()
+                if path is not None:
+                    cache.store(path, timeline)
+                yield name, timeline
+                submit()
+        finally:
+            # arrêt anticipé : on annule les fichiers pas encore commencés
+            for _, future, _ in pending:
+                future.cancel()
 
 def to3bytes(num):
     """
@@ -161,140 +523,185 @@ def to3bytes(num):
     return bytes(L[::-1])
 
 
-def makeFile(data, filename, step=10):
-    """
-    écrit un fichier à partir d'une liste échantillonée de notes
-    """
-    # ajout d'une frame vide pour l'arrêt des notes
-    data += [0 for i in range(131)]
-    # création du fichier
-    m = midi.MidiFile()
-
-    m.ticksPerQuarterNote = 480
-    m.format = 0
-
-    tr = midi.MidiTrack(0)
-    # delta_time 0
-    e = midi.DeltaTime(tr)
-    e.time = 0
-    tr.events.append(e)
-    # sequence_track_name (nom général)
-    e = midi.MidiEvent(tr)
-    e.channel = None
-    e.type = 'SEQUENCE_TRACK_NAME'
-    e.data = b'Generated file at '+filename.encode('latin')
-    tr.events.append(e)
-    # delta_time 0
-    e = midi.DeltaTime(tr)
-    e.time = 0
-    tr.events.append(e)
-    # sequence_track_name (nom de la piste)
-    e = midi.MidiEvent(tr)
-    e.channel = None
-    e.type = 'SEQUENCE_TRACK_NAME'
-    e.data = b'Generated track'
-    tr.events.append(e)
-    # delta_time 0
-    e = midi.DeltaTime(tr)
-    e.time = 0
-    tr.events.append(e)
-    # text_event (détails)
-    e = midi.MidiEvent(tr)
-    e.channel = None
-    e.type = 'TEXT_EVENT'
-    e.data = b'Generated by a LSTM'
-    tr.events.append(e)
-    # delta_time 0
-    e = midi.DeltaTime(tr)
-    e.time = 0
-    tr.events.append(e)
-    # smtpe_offset (obligatoire?)
-    e = midi.MidiEvent(tr)
-    e.channel = None
-    e.type = 'SMTPE_OFFSET'
-    e.data = b'`\x00\x03\x00\x00'
-    tr.events.append(e)
-    # delta_time 0
-    e = midi.DeltaTime(tr)
-    e.time = 0
-    tr.events.append(e)
-    # key_signature (obligatoire?)
-    e = midi.MidiEvent(tr)
-    e.channel = None
-    e.type = 'KEY_SIGNATURE'
-    e.data = b'\xff\x00'
-    tr.events.append(e)
-    # delta_time 0
-    e = midi.DeltaTime(tr)
-    e.time = 0
-    tr.events.append(e)
-    # set_tempo
-    e = midi.MidiEvent(tr)
-    e.channel = None
-    e.type = 'SET_TEMPO'
-    e.data = to3bytes(int(3*step*480*10))  # on choisi 30 ticks/frame, et 480 ticks/noire (limite au 1/8eme de croche)
-    tr.events.append(e)
-    # ajout des notes
-    currentlyPlaying = [0 for i in range(128)]
-    lastChange = -1
-    print(data[-1])
-    for n in range(len(data)):
-        # print(len(data[n]))
-        if type(data[n]) == type([]):
-            frame = data[n][:128]
-            changes = [i for i in range(128) if frame[i] != currentlyPlaying[i]]
-            if len(changes) > 0:
-                # delta_time
-                e = midi.DeltaTime(tr)
-                e.time = 30*(n-lastChange)
-                tr.events.append(e)
-                # note 0
-                e = midi.MidiEvent(tr)
-                e.channel = 1
-                e.type = 'NOTE_ON'
-                e.pitch = changes[0]
-                if frame[changes[0]] == 1:
-                    e.velocity = max(min(int(data[n][128]*128),127),0)
-                else:
-                    e.velocity = 0
-                tr.events.append(e)
-                for i in range(len(changes)-1):
-                    # delta_time
-                    e = midi.DeltaTime(tr)
-                    e.time = 0
-                    tr.events.append(e)
-                    # note 0
-                    e = midi.MidiEvent(tr)
-                    e.channel = 1
-                    e.type = 'NOTE_ON'
-                    e.pitch = changes[i+1]
-                    if frame[changes[i+1]] == 1:
-                        e.velocity = max(min(int(data[n][128]*128),127),0)
-                    else:
-                        e.velocity = 0
-                    tr.events.append(e)
-
-                lastChange = n
-            currentlyPlaying = frame
-    # delta_time 0
-    e = midi.DeltaTime(tr)
-    e.time = 0
-    tr.events.append(e)
-    # fin de piste
-    e = midi.MidiEvent(tr)
-    e.channel = None
-    e.type = 'END_OF_TRACK'
-    e.data = b''
-    tr.events.append(e)
-    m.tracks.append(tr)
+def variableLengthBytes(values):
+    """
+    Codage en nombres de longueur variable (midi) d'un tableau d'entiers
+    :return: (octets, nombre d'octets de chaque nombre)
+    """
+    values = np.asarray(values, dtype=np.int64)
+    sizes = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    ends = np.cumsum(sizes)
+    out = np.zeros(int(ends[-1]) if len(ends) else 0, dtype=np.uint8)
+    # octet k en partant de la fin : 7 bits, avec le bit de poids fort à 1 sauf pour le dernier
+    for k in range(4):
+        has = sizes > k
+        out[ends[has] - 1 - k] = ((values[has] >> 7*k) & 0x7F) | (0x80 if k > 0 else 0)
+    return out, sizes
+
+
+def frameEvents(frames, playing=None, lastChange=-1, ticksPerFrame=30):
+    """
+    Octets des évènements midi (temps delta et NOTE_ON) des changements de
+    notes d'un tableau échantillonné
+    :param frames: tableau (étapes x 129 et plus), colonnes 0 à 127 pour les
+                   notes (jouée si >= 0.5), 128 pour la vitesse
+    :param playing: notes jouées avant la première étape (défaut aucune)
+    :param lastChange: étape du dernier changement, relative à la première
+                       étape de frames
+    :param ticksPerFrame: durée d'une étape (ticks)
+    :return: (octets, notes jouées à la dernière étape, étape du dernier
+             changement relative à la première étape de frames)
+    """
+    frames = np.asarray(frames)
+    notes = frames[:, :128] >= 0.5
+    if playing is None:
+        playing = np.zeros(128, dtype=bool)
+    if len(frames) == 0:
+        return b'', playing, lastChange
+    # étapes qui changent par rapport à la précédente, en comparant les
+    # lignes compactées en 16 octets
+    notes = np.vstack([playing, notes])
+    packed = np.packbits(notes, axis=1).view(np.uint64)
+    changed = np.nonzero((packed[1:] != packed[:-1]).any(axis=1))[0]
+    if len(changed) == 0:
+        return b'', notes[-1], lastChange
+    # changements de ces étapes, dans l'ordre des étapes puis des notes
+    diffs = notes[changed + 1].astype(np.int8) - notes[changed]
+    index, pitches = np.nonzero(diffs)
+    rows = changed[index]
+    # le temps delta est nul sauf pour le premier changement de chaque étape
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = rows[1:] != rows[:-1]
+    deltas = np.zeros(len(rows), dtype=np.int64)
+    deltas[first] = ticksPerFrame*np.diff(np.concatenate([[lastChange], changed]))
+    # vitesse nulle pour l'arrêt d'une note
+    velocity = np.clip(np.trunc(frames[rows, 128]*128), 0, 127).astype(np.uint8)
+    velocity[diffs[index, pitches] < 0] = 0
+    # chaque évènement : temps delta, puis NOTE_ON canal 1, note, vitesse
+    timeBytes, sizes = variableLengthBytes(deltas)
+    starts = np.cumsum(sizes + 3) - sizes - 3
+    out = np.empty(int(starts[-1] + sizes[-1] + 3), dtype=np.uint8)
+    timeStarts = np.cumsum(sizes) - sizes
+    idx = np.repeat(starts - timeStarts, sizes) + np.arange(len(timeBytes))
+    out[idx] = timeBytes
+    out[starts + sizes] = 0x90
+    out[starts + sizes + 1] = pitches
+    out[starts + sizes + 2] = velocity
+    return out.tobytes(), notes[-1], int(changed[-1])
+
+
+def metaEvent(type, data):
+    """
+    Octets d'un méta évènement midi, précédé d'un temps delta nul
+    """
+    e = midi.MidiEvent(None)
+    e.type = type
+    e.data = data
+    return midi.putVariableLengthNumber(0) + e.write()
+
+
+class MidiWriter:
+    """
+    Écriture progressive d'un fichier midi (format 0, une piste) à partir
+    d'étapes de tableau échantillonné : les évènements sont écrits au fur et
+    à mesure, et la longueur de la piste est corrigée à chaque flush, fait
+    par add toutes les flushEvery étapes, pour qu'un fichier interrompu reste
+    lisible (jusqu'au dernier flush)
+    """
+
+    def __init__(self, filename, step=10, flushEvery=100):
+        """
+        :param filename: fichier à écrire
+        :param step: pas de quantification de la musique (ms)
+        :param flushEvery: nombre d'étapes ajoutées entre deux flush
+        """
+        self.file = open(filename, 'wb')
+        self.file.write(b'MThd' + midi.putNumber(6, 4) + midi.putNumber(0, 2) + midi.putNumber(1, 2) + midi.putNumber(480, 2))
+        # longueur de la piste écrite au flush
+        self.trackStart = self.file.tell()
+        self.file.write(b'MTrk\x00\x00\x00\x00')
+        # évènements de début de piste
+        header = [('SEQUENCE_TRACK_NAME', b'Generated file at '+filename.encode('latin')),  # nom général
+                  ('SEQUENCE_TRACK_NAME', b'Generated track'),  # nom de la piste
+                  ('TEXT_EVENT', b'Generated by a LSTM'),  # détails
+                  ('SMTPE_OFFSET', b'`\x00\x03\x00\x00'),  # obligatoire?
+                  ('KEY_SIGNATURE', b'\xff\x00'),  # obligatoire?
+                  # on choisi 30 ticks/frame, et 480 ticks/noire (limite au 1/8eme de croche)
+                  ('SET_TEMPO', to3bytes(int(3*step*480*10)))]
+        for type, eventData in header:
+            self.file.write(metaEvent(type, eventData))
+        # notes jouées à la dernière étape écrite, et étape du dernier
+        # changement relative à la prochaine étape
+        self.playing = None
+        self.lastChange = -1
+        self.flushEvery = flushEvery
+        self.unflushed = 0  # étapes ajoutées depuis le dernier flush
+
+    def add(self, frames):
+        """
+        Écrit une étape (vecteur) ou une suite d'étapes (tableau étapes x 129 et
+        plus), colonnes 0 à 127 pour les notes, 128 pour la vitesse.
+        La longueur de la piste est corrigée (flush) dès que flushEvery
+        étapes ont été ajoutées depuis la dernière correction
+        """
+        frames = np.asarray(frames)
+        if frames.ndim == 1:
+            frames = frames[np.newaxis]
+        events, self.playing, lastChange = frameEvents(frames, self.playing, self.lastChange)
+        self.file.write(events)
+        self.lastChange = lastChange - len(frames)
+        self.unflushed += len(frames)
+        if self.unflushed >= self.flushEvery:
+            self.flush()
+
+    def flush(self):
+        """
+        Corrige la longueur de la piste et vide les tampons sur le disque
+        """
+        end = self.file.tell()
+        self.file.seek(self.trackStart + 4)
+        self.file.write(midi.putNumber(end - self.trackStart - 8, 4))
+        self.file.seek(end)
+        self.file.flush()
+        self.unflushed = 0
+
+    def close(self):
+        """
+        Arrête les notes jouées, termine la piste et ferme le fichier
+        """
+        if self.file.closed:
+            return
+        # une étape vide pour l'arrêt des notes
+        self.add(np.zeros(129))
+        self.file.write(metaEvent('END_OF_TRACK', b''))
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def makeFile(data, filename, step=10, debug=False):
+    """
+    écrit un fichier à partir d'un tableau échantillonné de notes
+    :param data: tableau (étapes x 129 et plus), colonnes 0 à 127 pour les
+                 notes, 128 pour la vitesse
+    :param debug: écrit aussi le détail de la piste dans midi_write.txt
+    """
+    with MidiWriter(filename, step) as writer:
+        writer.add(data)
     # débug
-    f = open('midi_write.txt', 'w')
-    print(m.tracks[0], file=f)
-    f.close()
-    # écriture
-    m.open(filename, 'wb')
-    m.write()
-    m.close()
+    if debug:
+        m = midi.MidiFile()
+        m.open(filename)
+        m.read()
+        m.close()
+        f = open('midi_write.txt', 'w')
+        print(m.tracks[0], file=f)
+        f.close()
 
 if __name__ == '__main__':
     print('load file')
@@ -6,8 +6,11 @@ import tkinter.messagebox
 import os
 import threading
 import file
+import corpus
+import dataset
 import time
 import random
+import numpy as np
 from LSTM import LSTM
 
 
@@ -415,6 +418,11 @@ class Interface(tk.Tk):
         self.dataLock = threading.Lock()
         self.dataQueue = []
         self.dataSpace = 1 # nombre de fichiers chargés en avance
+        self.loadWorkers = None # nombre de processus de lecture (défaut: nombre de coeurs)
+        self.maxTransposition = 0 # transposition aléatoire des morceaux, entre -n et n demi-tons
+        self.windowLength = 0 # entrainement par fenêtres de n étapes (0: morceaux entiers)
+        self.windowStride = None # décalage entre deux fenêtres (défaut: windowLength)
+        self.batchSize = 1 # nombre de fenêtres par mise à jour des poids
         # écriture d'un nouveau fichier
         self.creationThread = None
         self.creationFinished = True
@@ -554,18 +562,32 @@ class Interface(tk.Tk):
         """
         if not fileList:
             return
+        # tableaux creux, convertis en fenêtres complètes au moment de l'entrainement
+        encoder = file.RollEncoder(36, fold=True, step=self.entryStep.get_value(), timeLimit=self.entryTroncature.get_value(), sparse=True)
+        # les fichiers déjà encodés (aux époques précédentes) sont relus du cache,
+        # le même pour tout l'entrainement pour ne hasher chaque fichier qu'une fois
+        cache = file.RollCache(encoder, 'data/cache')
         for k in range(self.entryEpoch.get_value()):
             rdFileList = fileList[:]
             random.shuffle(rdFileList)
-            for name in rdFileList:
+            # directement tirés du corpus compilé (corpus.py) s'il les contient tous
+            compiled = corpus.Corpus.open_for(encoder, 'data/corpus')
+            if compiled is not None and all(name in compiled for name in rdFileList):
+                loaded = ((name, compiled[name]) for name in rdFileList)
+            else:
+                # sinon lus en parallèle par un pool de processus
+                loaded = file.load_files(['musics/format 0/'+name for name in rdFileList], encoder, self.loadWorkers, cache=cache)
+            for name, (_, data) in zip(rdFileList, loaded):
                 # attend d'avoir à charger un fichier
                 while self.dataSpace == 0 and not self.stoppingTraining:
                     time.sleep(0.1)
                 if self.stoppingTraining:
                     print('DATA STOP')
+                    loaded.close()
                     return
-                # lis le fichier
-                data = file.load_file_mod('musics/format 0/'+name, self.entryStep.get_value(), self.entryTroncature.get_value())
+                # augmentation des données : transposition sans copie du morceau
+                if self.maxTransposition > 0:
+                    data = encoder.transpose(data, random.randint(-self.maxTransposition, self.maxTransposition))
                 # charge les données dans la file
                 self.dataLock.acquire()
                 self.dataQueue.append( (name, data) )
@@ -610,11 +632,29 @@ class Interface(tk.Tk):
                     print('STOP!')
                     self.waitingForStop = False
                     return
-                # transforme en entrées -> sorties
-                x = data[:-1]
-                y = data[1:]
-                # entraine
-                cost, _, _ = self.reseau.graph.train(x, y, self.reseau.learning_rate)
+                # découpe le morceau en fenêtres, en lots de fenêtres de longueurs proches
+                if self.windowLength > 0:
+                    windows = dataset.WindowDataset(self.windowLength + 1, self.windowStride)
+                    windows.add(name, data)
+                    batches = windows.batches(self.batchSize)
+                else:
+                    batches = [[data]]
+                if not batches:
+                    continue
+                costs = []
+                for batch in batches:
+                    if len(batch) == 1:
+                        # transforme en entrées -> sorties
+                        x = batch[0][:-1]
+                        y = batch[0][1:]
+                        # entraine
+                        cost, _ = self.reseau.call_graph('train', x, y, self.reseau.learning_rate)
+                    else:
+                        # lot de fenêtres, complété par des zéros
+                        x, mask, y = self.reseau.pad_batch([seq[:-1] for seq in batch], [seq[1:] for seq in batch])
+                        cost, _ = self.reseau.call_graph('train_batch', x, mask, y, self.reseau.learning_rate)
+                    costs.append(cost)
+                cost = sum(costs)/len(costs)
                 print('erreur :', cost)
                 self.trainingDialog.add_error(cost)
                 if cost <= self.entryError.get_value():
@@ -651,19 +691,15 @@ class Interface(tk.Tk):
         print('Start generation')
         # génère la musique
         frames = self.reseau.predict([1*(i==37) for i in range(39)], [0], self.entryTroncature.get_value())
-        frames = frames.tolist()
-        res = [[0 for k in range(128 + 3)] for n in range(len(frames))]
-        # fixe à 0 ou 1 les notes
-        for n in range(len(res)):
-            # max_key = frames[n].index(max(frames[n]))
-            # frames[n][max_key] = 1.
-            for i in range(36):
-            #     if i != max_key:
-            #         frames[n][i] = 0.
-                res[n][48+i] = int(frames[n][i]+0.5)
+        frames = np.asarray(frames)
+        res = np.zeros((len(frames), 128 + 3))
+        # fixe à 0 ou 1 les notes, placées sur les 36 notes à partir de la 48ème,
+        # et remet la vitesse à l'échelle de 128
+        res[:, 48:48+36] = frames[:, :36] >= 0.5
+        res[:, 128] = frames[:, 36]*36/128
         print('Saving '+str(len(frames))+' frames')
         # enregistre
-        file.makeFile(frames, 'test.mid', self.entryStep.get_value())
+        file.makeFile(res, 'test.mid', self.entryStep.get_value())
         self.creationFinished = True
         print('Musique écrite!')
         
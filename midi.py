@@ -15,7 +15,9 @@ http://www.argonet.co.uk/users/lenny/midi/mfile.html
 *** UPDATED FOR PYTHON 3.2.1 BY KADIR HALDENBILEN 07.03.2015
 """
 
-import sys, string, types       #, exceptions
+import sys, string, types, mmap, collections, threading       #, exceptions
+import concurrent.futures
+import numpy as np
 
 debugflag = 0
 
@@ -47,6 +49,25 @@ def getVariableLengthNumber(str):
         if not (x & 0x80):
             return sum, str[i:]
 
+# Cursor versions of the two readers above: instead of returning the
+# remainder of the buffer (which copies it), they return the offset of
+# the next unread byte. Used by the readAt() methods below.
+
+def getNumberAt(buf, pos, length):
+    sum = 0
+    for i in range(pos, pos + length):
+        sum = (sum << 8) + buf[i]
+    return sum, pos + length
+
+def getVariableLengthNumberAt(buf, pos):
+    sum = 0
+    while 1:
+        x = buf[pos]
+        pos = pos + 1
+        sum = (sum << 7) + (x & 0x7F)
+        if not (x & 0x80):
+            return sum, pos
+
 def putNumber(num, length):
     # MIDI uses big-endian for everything
     lst = [ ]
@@ -149,12 +170,109 @@ metaEvents = Enumeration([("SEQUENCE_NUMBER", 0x00),
                           ("KEY_SIGNATURE", 0x59),
                           ("SEQUENCER_SPECIFIC_META_EVENT", 0x7F)])
 
-# runningStatus appears to want to be an attribute of a MidiTrack. But
-# it doesn't seem to do any harm to implement it as a global.
-runningStatus = None
+# Every event type with a small integer code, used by the compact
+# (struct-of-arrays) track representation. Code 0 is DeltaTime.
+eventTypes = Enumeration(["DeltaTime"] +
+                         list(channelVoiceMessages.lookup.keys()) +
+                         list(channelModeMessages.lookup.keys()) +
+                         ["F0_SYSEX_EVENT", "F7_SYSEX_EVENT"] +
+                         list(metaEvents.lookup.keys()))
+
+eventTypeNames = [eventTypes.whatis(i) for i in range(len(eventTypes.lookup))]
+
+# codes compared in the parsing loops
+NOTE_OFF = eventTypes.NOTE_OFF
+NOTE_ON = eventTypes.NOTE_ON
+SET_TEMPO = eventTypes.SET_TEMPO
+LOCAL_CONTROL = eventTypes.LOCAL_CONTROL
+intDataTypes = frozenset([eventTypes.PROGRAM_CHANGE,
+                          eventTypes.CHANNEL_KEY_PRESSURE,
+                          eventTypes.MONO_MODE_ON])
+
+# Dispatch table of decodeEvent: for each status byte, None if it is not
+# a valid status, else (kind, type code, channel). Meta event types are
+# looked up in metaTable, by the byte following 0xFF.
+VOICE_2BYTES, VOICE_1BYTE, SYSEX, META = range(4)
+
+def makeStatusTable():
+    table = [None] * 256
+    for name, y in channelVoiceMessages.lookup.items():
+        if name == "PROGRAM_CHANGE" or name == "CHANNEL_KEY_PRESSURE":
+            kind = VOICE_1BYTE
+        else:
+            kind = VOICE_2BYTES
+        for i in range(16):
+            table[y + i] = (kind, eventTypes.lookup[name], i + 1)
+    table[0xF0] = (SYSEX, eventTypes.F0_SYSEX_EVENT, None)
+    table[0xF7] = (SYSEX, eventTypes.F7_SYSEX_EVENT, None)
+    table[0xFF] = (META, None, None)
+    return table
+
+statusTable = makeStatusTable()
+metaTable = [None] * 256
+for name, z in metaEvents.lookup.items():
+    metaTable[z] = eventTypes.lookup[name]
+
+def decodeEvent(buf, pos, status):
+    """Decode the event starting at offset pos of buf (bytes, memoryview
+    or mmap), status being the current running status. Returns
+    (pos, status, type, channel, pitch, velocity, dataStart, dataEnd):
+    the offset of the following byte, the new running status, and the
+    fields of the event, type being a code of eventTypes. The raw data
+    of the event is buf[dataStart:dataEnd], dataStart is -1 when the
+    event has no data."""
+    # do we need to use running status? If so the status byte is
+    # implicit and the data bytes start right at pos
+    x = buf[pos]
+    if x & 0x80:
+        pos = pos + 1
+    elif status is None:
+        raise ValueError("data byte %02X at offset %d with no running status"
+                         % (x, pos))
+    else:
+        x = status
+    entry = statusTable[x]
+    if entry is None:
+        raise ValueError("unknown midi event type %02X at offset %d"
+                         % (x, pos - 1))
+    kind, type, channel = entry
+
+    if kind == VOICE_2BYTES:
+        return pos + 2, x, type, channel, buf[pos], buf[pos + 1], -1, -1
+
+    elif kind == VOICE_1BYTE:
+        return pos + 1, x, type, channel, None, None, pos, pos + 1
+
+    elif kind == SYSEX:
+        length, pos = getVariableLengthNumberAt(buf, pos)
+        return pos + length, x, type, None, None, None, pos, pos + length
+
+    z = buf[pos]
+    type = metaTable[z]
+    if type is None:
+        raise ValueError("unknown meta event FF %02X at offset %d"
+                         % (z, pos - 1))
+    length, pos = getVariableLengthNumberAt(buf, pos + 1)
+    return pos + length, x, type, None, None, None, pos, pos + length
+
+def eventData(type, raw):
+    """Convert the raw data bytes of an event to the value MidiEvent.data
+    holds for this event type (a code of eventTypes)."""
+    if raw is None:
+        return None
+    if type in intDataTypes:
+        return raw[0]
+    if type == LOCAL_CONTROL:
+        return raw[0] == 0x7F
+    if type == SET_TEMPO:
+        return int.from_bytes(raw, 'big')
+    return bytes(raw)
 
 class MidiEvent:
 
+    # code of the event type in eventTypes, see the type property
+    typeCode = None
+
     def __init__(self, track):
         self.track = track
         self.time = None
@@ -175,70 +293,39 @@ class MidiEvent:
                 r = r + ", " + attrib + "=" + repr(getattr(self, attrib))
         return r + ">"
 
+    @property
+    def type(self):
+        if self.typeCode is None:
+            return None
+        return eventTypeNames[self.typeCode]
+
+    @type.setter
+    def type(self, name):
+        self.typeCode = eventTypes.lookup[name]
+
     def read(self, time, str):
-        global runningStatus
+        pos = self.readAt(time, str, 0)
+        return str[pos:]
+
+    def readAt(self, time, buf, pos):
+        """Read the event starting at offset pos of buf (bytes, memoryview
+        or mmap) and return the offset of the following byte."""
+        # the running status is kept by the track, so that tracks and
+        # files can be read concurrently
         self.time = time
-        #print ("RS", runningStatus, "str0", str[0])
-        #print ("len str", len(str), "type str", type(str))
-        #print ("str", str[:100])
-        # do we need to use running status?
-        if not (str[0] & 0x80):
-            #print ("RS inside", runningStatus, "str0 inside", str[0])
-            #print ("type RS inside", type(runningStatus), "type str0 inside", type(str[0]))
-            #str = runningStatus + str      original
-            str = runningStatus.to_bytes(1, byteorder="big") + str      # KH
-        runningStatus = x = str[0]
-        #x = ord(x)
-        y = x & 0xF0
-        z = str[1]      # ord KH
-
-        if channelVoiceMessages.has_value(y):
-            self.channel = (x & 0x0F) + 1
-            self.type = channelVoiceMessages.whatis(y)
-            if (self.type == "PROGRAM_CHANGE" or
-                self.type == "CHANNEL_KEY_PRESSURE"):
-                self.data = z
-                return str[2:]
-            else:
-                self.pitch = z
-                self.velocity = str[2]      # ord KH
-                channel = self.track.channels[self.channel - 1]
-                if (self.type == "NOTE_OFF" or
-                    (self.velocity == 0 and self.type == "NOTE_ON")):
-                    channel.noteOff(self.pitch, self.time)
-                elif self.type == "NOTE_ON":
-                    channel.noteOn(self.pitch, self.time, self.velocity)
-                return str[3:]
-
-        elif y == 0xB0 and channelModeMessages.has_value(z):
-            self.channel = (x & 0x0F) + 1
-            self.type = channelModeMessages.whatis(z)
-            if self.type == "LOCAL_CONTROL":
-                self.data = (str[2] == 0x7F)        #ord KH
-            elif self.type == "MONO_MODE_ON":
-                self.data = str[2]              #ord KH
-            return str[3:]
-
-        elif x == 0xF0 or x == 0xF7:
-            self.type = {0xF0: "F0_SYSEX_EVENT",
-                         0xF7: "F7_SYSEX_EVENT"}[x]
-            length, str = getVariableLengthNumber(str[1:])
-            self.data = str[:length]
-            return str[length:]
-
-        elif x == 0xFF:
-            if not metaEvents.has_value(z):
-                print ("Unknown meta event: FF %02X" % z)
-                sys.stdout.flush()
-                raise ("Unknown midi event type")
-            self.type = metaEvents.whatis(z)
-            length, str = getVariableLengthNumber(str[2:])
-            self.data = str[:length]
-            if self.type == "SET_TEMPO":
-                self.data = int.from_bytes(self.data, 'big')
-            return str[length:]
-
-        raise ("Unknown midi event type")
+        (pos, self.track.runningStatus, self.typeCode, self.channel,
+         self.pitch, self.velocity, start, end) = \
+            decodeEvent(buf, pos, self.track.runningStatus)
+        if start >= 0:
+            self.data = eventData(self.typeCode, buf[start:end])
+        if self.pitch is not None:
+            channel = self.track.channels[self.channel - 1]
+            if (self.typeCode == NOTE_OFF or
+                (self.velocity == 0 and self.typeCode == NOTE_ON)):
+                channel.noteOff(self.pitch, self.time)
+            elif self.typeCode == NOTE_ON:
+                channel.noteOn(self.pitch, self.time, self.velocity)
+        return pos
 
     def write(self):
         sysex_event_dict = {"F0_SYSEX_EVENT": 0xF0,
@@ -249,14 +336,18 @@ class MidiEvent:
                 self.type != "CHANNEL_KEY_PRESSURE"):
                 data = bytes([self.pitch, self.velocity])
             else:
-                data = chr(self.data)
+                data = bytes([self.data])
             return x + data
 
         elif channelModeMessages.hasattr(self.type):
             x = getattr(channelModeMessages, self.type)
+            if self.type == "LOCAL_CONTROL":
+                data = 0x7F if self.data else 0
+            else:
+                data = self.data or 0
             x = bytes([0xB0 + (self.channel - 1)]) + \
                 bytes([x]) + \
-                self.data
+                bytes([data])
             return x
 
         elif self.type in sysex_event_dict.keys():
@@ -265,9 +356,12 @@ class MidiEvent:
             return str + self.data
 
         elif metaEvents.hasattr(self.type):
+            data = self.data
+            if type(data) == int:     # SET_TEMPO as read by readAt
+                data = putNumber(data, 3)
             str = bytes(chr(0xFF) + chr(getattr(metaEvents, self.type)), 'latin')
-            str = str + putVariableLengthNumber(len(self.data))
-            return str + self.data
+            str = str + putVariableLengthNumber(len(data))
+            return str + data
 
         else:
             raise ("unknown midi event type: " + self.type)
@@ -309,8 +403,9 @@ class MidiChannel:
     def noteOff(self, pitch, time):
         if pitch in self.pitches.keys():
             keyDownTime, velocity = self.pitches[pitch]
-            register_note(self.track.index, self.index, pitch, velocity,
-                          keyDownTime, time)
+            hook = self.track.register_note or register_note
+            hook(self.track.index, self.index, pitch, velocity,
+                 keyDownTime, time)
             del self.pitches[pitch]
         # The case where the pitch isn't in the dictionary is illegal,
         # I think, but we probably better just ignore it.
@@ -318,15 +413,52 @@ class MidiChannel:
 class DeltaTime(MidiEvent):
 
     type = "DeltaTime"
+    typeCode = eventTypes.DeltaTime
 
     def read(self, oldstr):
         self.time, newstr = getVariableLengthNumber(oldstr)
         return self.time, newstr
 
+    def readAt(self, buf, pos):
+        self.time, pos = getVariableLengthNumberAt(buf, pos)
+        return self.time, pos
+
     def write(self):
         str = putVariableLengthNumber(self.time)
         return str
 
+Notes = collections.namedtuple("Notes", ["onset", "offset", "pitch",
+                                       "velocity", "channel", "track"])
+
+def pairNotes(time, type, channel, pitch, velocity, track):
+    """Pair the NOTE_ON and NOTE_OFF events of a track given as parallel
+    arrays (type codes of eventTypes) and return its Notes, sorted by
+    onset then pitch. The pairing is the one MidiChannel does: per channel
+    and pitch, a note on replaces a pending one, and a note off (or note
+    on of velocity 0) ends the pending note, if any. This comes down to
+    keeping the note ons directly followed by a note off in their
+    (channel, pitch) group, which is done in one pass over sorted arrays."""
+    time = np.asarray(time, dtype=np.int64)
+    type = np.asarray(type)
+    velocity = np.asarray(velocity)
+    isOn = (type == NOTE_ON) & (velocity > 0)
+    isOff = (type == NOTE_OFF) | ((type == NOTE_ON) & (velocity == 0))
+    idx = np.nonzero(isOn | isOff)[0]
+    # group by (channel, pitch), keeping the event order inside a group
+    idx = idx[np.lexsort((idx, np.asarray(pitch)[idx],
+                          np.asarray(channel)[idx]))]
+    ch, p, on = np.asarray(channel)[idx], np.asarray(pitch)[idx], isOn[idx]
+    keep = (on[:-1] & ~on[1:] &
+            (ch[:-1] == ch[1:]) & (p[:-1] == p[1:]))
+    first, last = idx[:-1][keep], idx[1:][keep]
+    order = np.lexsort((np.asarray(pitch)[first], time[first]))
+    first, last = first[order], last[order]
+    return Notes(time[first], time[last],
+                 np.asarray(pitch)[first].astype(np.int16),
+                 velocity[first].astype(np.int16),
+                 np.asarray(channel)[first].astype(np.int16),
+                 np.full(len(first), track, dtype=np.int16))
+
 class MidiTrack:
 
     def __init__(self, index):
@@ -334,34 +466,74 @@ class MidiTrack:
         self.events = [ ]
         self.channels = [ ]
         self.length = 0
+        self.runningStatus = None
+        # note hook of this track, the module-level register_note if None
+        self.register_note = None
         for i in range(16):
             self.channels.append(MidiChannel(self, i+1))
 
     def read(self, str):
+        pos = self.readAt(memoryview(str), 0)
+        return str[pos:]
+
+    def readAt(self, buf, pos):
+        """Read the MTrk chunk starting at offset pos of buf, walking it
+        with an integer cursor, and return the offset of the next chunk."""
         time = 0
-        #print ("trk04", str[:4])
-        assert str[:4] == b"MTrk"
-        length, str = getNumber(str[4:], 4)
+        self.runningStatus = None
+        #print ("trk04", buf[pos:pos+4])
+        assert buf[pos:pos + 4] == b"MTrk"
+        length, pos = getNumberAt(buf, pos + 4, 4)
         self.length = length
-        mystr = str[:length]
-        remainder = str[length:]
-        while mystr:
+        end = pos + length
+        while pos < end:
             delta_t = DeltaTime(self)
-            dt, mystr = delta_t.read(mystr)
+            dt, pos = delta_t.readAt(buf, pos)
             time = time + dt
             self.events.append(delta_t)
             e = MidiEvent(self)
-            mystr = e.read(time, mystr)
+            pos = e.readAt(time, buf, pos)
             self.events.append(e)
-        return remainder
+        return end
 
     def write(self):
-        time = self.events[0].time
-        # build str using MidiEvents
-        str = b""
-        for e in self.events:
-            str = str + e.write()
-        return b"MTrk" + putNumber(len(str), 4) + str
+        out = bytearray()
+        self.writeTo(out)
+        return bytes(out)
+
+    def writeTo(self, out):
+        """Append the MTrk chunk to out, a bytearray or a seekable binary
+        file, in a single pass. The chunk length is not known until the
+        events are written, so it is patched in afterwards."""
+        if isinstance(out, bytearray):
+            start = len(out)
+            out += b"MTrk\x00\x00\x00\x00"
+            for e in self.events:
+                out += e.write()
+            out[start + 4:start + 8] = putNumber(len(out) - start - 8, 4)
+        else:
+            start = out.tell()
+            out.write(b"MTrk\x00\x00\x00\x00")
+            for e in self.events:
+                out.write(e.write())
+            end = out.tell()
+            out.seek(start + 4)
+            out.write(putNumber(end - start - 8, 4))
+            out.seek(end)
+
+    def notes(self):
+        """All the notes of the track as numpy arrays, see pairNotes"""
+        events = [e for e in self.events if e.pitch is not None]
+        return pairNotes([e.time for e in events],
+                         [e.typeCode for e in events],
+                         [e.channel for e in events],
+                         [e.pitch for e in events],
+                         [e.velocity for e in events], self.index)
+
+    def tempos(self):
+        """Ticks and tempos (µs per quarter note) of the SET_TEMPO events"""
+        events = [e for e in self.events if e.typeCode == SET_TEMPO]
+        return ([e.time for e in events], [e.data for e in events])
 
     def __repr__(self):
         r = "<MidiTrack %d -- %d events\n" % (self.index, len(self.events))
@@ -370,6 +542,145 @@ class MidiTrack:
         return r + "  >"
 
 
+class CompactTrack(MidiTrack):
+
+    """A track stored as parallel numpy arrays, one entry per event
+    (DeltaTime events are not stored, times are absolute):
+
+        time       absolute tick (int64)
+        type       event type code, see eventTypes (uint8)
+        channel    channel 1-16, or -1 (int8)
+        pitch      pitch, or -1 (int8)
+        velocity   velocity, or -1 (int8)
+        dataStart, dataEnd
+                   slice of the event data in self.payload, -1 when the
+                   event has no data (int32)
+
+    self.events is a read-only view building the usual DeltaTime and
+    MidiEvent objects on demand, so code iterating over the events of a
+    MidiTrack keeps working. Reading a CompactTrack does not go through
+    MidiChannel, so register_note is not called."""
+
+    def __init__(self, index):
+        self.index = index
+        self.length = 0
+        self.register_note = None
+        self.time = np.zeros(0, dtype=np.int64)
+        self.type = np.zeros(0, dtype=np.uint8)
+        self.channel = np.zeros(0, dtype=np.int8)
+        self.pitch = np.zeros(0, dtype=np.int8)
+        self.velocity = np.zeros(0, dtype=np.int8)
+        self.dataStart = np.zeros(0, dtype=np.int32)
+        self.dataEnd = np.zeros(0, dtype=np.int32)
+        self.payload = b""
+
+    def __len__(self):
+        return len(self.time)
+
+    @property
+    def events(self):
+        return CompactEventView(self)
+
+    def readAt(self, buf, pos):
+        time = 0
+        status = None
+        assert buf[pos:pos + 4] == b"MTrk"
+        length, pos = getNumberAt(buf, pos + 4, 4)
+        self.length = length
+        end = pos + length
+        times, types, channels, pitches, velocities = [ ], [ ], [ ], [ ], [ ]
+        starts, ends = [ ], [ ]
+        payload = bytearray()
+        while pos < end:
+            dt, pos = getVariableLengthNumberAt(buf, pos)
+            time = time + dt
+            (pos, status, type, channel, pitch, velocity,
+             start, stop) = decodeEvent(buf, pos, status)
+            times.append(time)
+            types.append(type)
+            channels.append(-1 if channel is None else channel)
+            pitches.append(-1 if pitch is None else pitch)
+            velocities.append(-1 if velocity is None else velocity)
+            if start >= 0:
+                starts.append(len(payload))
+                payload += buf[start:stop]
+                ends.append(len(payload))
+            else:
+                starts.append(-1)
+                ends.append(-1)
+        self.time = np.array(times, dtype=np.int64)
+        self.type = np.array(types, dtype=np.uint8)
+        self.channel = np.array(channels, dtype=np.int8)
+        self.pitch = np.array(pitches, dtype=np.int8)
+        self.velocity = np.array(velocities, dtype=np.int8)
+        self.dataStart = np.array(starts, dtype=np.int32)
+        self.dataEnd = np.array(ends, dtype=np.int32)
+        self.payload = bytes(payload)
+        return end
+
+    def mask(self, *types):
+        """Boolean array selecting the events of the given types (names)"""
+        return np.isin(self.type, [eventTypes.lookup[t] for t in types])
+
+    def notes(self):
+        return pairNotes(self.time, self.type, self.channel, self.pitch,
+                         self.velocity, self.index)
+
+    def tempos(self):
+        idx = np.nonzero(self.type == SET_TEMPO)[0]
+        return (self.time[idx],
+                [eventData(SET_TEMPO, self.payload[self.dataStart[n]:
+                                                   self.dataEnd[n]])
+                 for n in idx])
+
+    def event(self, n):
+        """Build the MidiEvent object of the n-th event"""
+        e = MidiEvent(self)
+        e.time = int(self.time[n])
+        e.typeCode = int(self.type[n])
+        if self.channel[n] >= 0:
+            e.channel = int(self.channel[n])
+        if self.pitch[n] >= 0:
+            e.pitch = int(self.pitch[n])
+            e.velocity = int(self.velocity[n])
+        if self.dataStart[n] >= 0:
+            raw = self.payload[self.dataStart[n]:self.dataEnd[n]]
+            e.data = eventData(e.typeCode, raw)
+        return e
+
+
+class CompactEventView:
+
+    """MidiTrack.events-like sequence over a CompactTrack, alternating
+    DeltaTime and MidiEvent objects that are built on access."""
+
+    def __init__(self, track):
+        self.track = track
+
+    def __len__(self):
+        return 2 * len(self.track)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i = i + len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("event index out of range")
+        n, odd = divmod(i, 2)
+        if odd:
+            return self.track.event(n)
+        e = DeltaTime(self.track)
+        e.time = int(self.track.time[n])
+        if n > 0:
+            e.time = e.time - int(self.track.time[n - 1])
+        return e
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 # Track0 Hook to read Track 0 data, similar to register_note function
 # added by K.H.
 
@@ -377,16 +688,141 @@ def register_track0(tracks0_data):
     pass
 
 
+def readHeader(buf):
+    """Read the MThd chunk at the start of buf. Returns (format,
+    numTracks, division, pos), pos being the offset of the first track."""
+    assert buf[:4] == b"MThd"
+    length, pos = getNumberAt(buf, 4, 4)
+    assert length == 6
+    format, pos = getNumberAt(buf, pos, 2)
+    assert format == 0 or format == 1   # dunno how to handle 2
+    numTracks, pos = getNumberAt(buf, pos, 2)
+    division, pos = getNumberAt(buf, pos, 2)
+    return format, numTracks, division, pos
+
+def trackOffsets(buf, pos, numTracks):
+    """Offsets of the numTracks MTrk chunks starting at pos, found by
+    reading the chunk headers only."""
+    offsets = [ ]
+    for i in range(numTracks):
+        assert buf[pos:pos + 4] == b"MTrk"
+        length, _ = getNumberAt(buf, pos + 4, 4)
+        offsets.append(pos)
+        pos = pos + 8 + length
+    return offsets
+
+
+class TempoMap:
+
+    """Tick to time conversion for a MidiFile. Every tempo change starts a
+    segment; the map keeps, for each segment, its first tick, its tempo
+    (µs per quarter note) and the time in µs at which it starts, so whole
+    arrays of ticks are converted with one searchsorted."""
+
+    def __init__(self, ticks, tempos, ticksPerQuarterNote=None,
+                 ticksPerSecond=None):
+        ticks = np.asarray(ticks, dtype=np.int64)
+        tempos = np.asarray(tempos, dtype=np.float64)
+        if len(ticks) == 0 or ticks[0] != 0:
+            # 120 bpm until the first tempo change
+            ticks = np.concatenate([[0], ticks])
+            tempos = np.concatenate([[500000.], tempos])
+        if ticksPerQuarterNote is None:
+            # SMPTE division: a fixed number of ticks per second
+            tempos = np.full(len(tempos), 1e6)
+            self.division = ticksPerSecond
+        else:
+            self.division = ticksPerQuarterNote
+        self.ticks = ticks
+        self.tempos = tempos
+        self.micros = np.zeros(len(ticks))
+        for k in range(1, len(ticks)):
+            self.micros[k] = ((ticks[k] - ticks[k - 1]) * tempos[k - 1] /
+                              self.division + self.micros[k - 1])
+
+    def toMicros(self, ticks):
+        """Time in µs of each tick of the array"""
+        ticks = np.asarray(ticks, dtype=np.int64)
+        seg = np.searchsorted(self.ticks, ticks, side="right") - 1
+        return ((ticks - self.ticks[seg]) * self.tempos[seg] /
+                self.division + self.micros[seg])
+
+    def toFrames(self, ticks, step):
+        """Index of the frame of step ms holding each tick of the array"""
+        return np.floor(self.toMicros(ticks) / (step * 1000)).astype(np.int64)
+
+
+class LazyTrackList:
+
+    """The tracks of a MidiFile read in lazy mode. Only the offsets of the
+    MTrk chunks are known up front; a track is parsed the first time it is
+    accessed. The buffer is released once every track has been parsed."""
+
+    def __init__(self, buf, offsets, midiFile):
+        self.buf = buf
+        self.offsets = offsets
+        self.midiFile = midiFile
+        self.parsed = [None] * len(offsets)
+        self.remaining = len(offsets)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i = i + len(self)
+        with self.lock:
+            trk = self.parsed[i]
+            if trk is None:
+                trk = self.midiFile.newTrack(i)
+                trk.readAt(self.buf, self.offsets[i])
+                self.parsed[i] = trk
+                if i == 0:
+                    self.midiFile.track0Hook(trk)
+                self.remaining = self.remaining - 1
+                if self.remaining == 0:
+                    self.buf.release()
+                    self.buf = None
+        return trk
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, trk):
+        self.offsets.append(None)
+        self.parsed.append(trk)
+
+
 class MidiFile:
 
-    def __init__(self):
+    def __init__(self, lazy=False, compact=False, workers=1,
+                 register_note=None, register_track0=None):
+        """If lazy is true, reading only scans the chunk headers and each
+        track is parsed the first time it is accessed in self.tracks.
+        If compact is true, tracks are read as CompactTrack objects.
+        With workers > 1, the tracks are parsed concurrently by a pool of
+        threads. register_note and register_track0 are the hooks called
+        while reading this file (the module-level ones if None)."""
+        self.lazy = lazy
+        self.trackClass = CompactTrack if compact else MidiTrack
+        self.workers = workers
+        self.register_note = register_note
+        self.register_track0 = register_track0
         self.file = None
+        self.mmap = None
         self.format = 1
         self.tracks = [ ]
         self.ticksPerQuarterNote = None
         self.ticksPerSecond = None
 
-    def open(self, filename, attrib="rb"):
+    def open(self, filename, attrib="rb", mapped=False):
+        """If mapped is true, a file opened for reading is memory-mapped
+        and read() parses the mapped pages directly instead of reading
+        them into a private copy."""
         if filename == None:
             if attrib in ["r", "rb"]:
                 self.file = sys.stdin
@@ -394,6 +830,9 @@ class MidiFile:
                 self.file = sys.stdout
         else:
             self.file = open(filename, attrib)
+            if mapped and attrib in ["r", "rb"]:
+                self.mmap = mmap.mmap(self.file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
 
     def __repr__(self):
         r = "<MidiFile %d tracks\n" % len(self.tracks)
@@ -402,23 +841,40 @@ class MidiFile:
         return r + ">"
 
     def close(self):
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # still used by tracks not parsed yet (lazy mode), the
+                # mapping goes away with them
+                pass
+            self.mmap = None
         self.file.close()
 
     def read(self):
-        self.readstr(self.file.read())
+        if self.mmap is not None:
+            self.readstr(self.mmap)
+        else:
+            self.readstr(self.file.read())
 
     def readstr(self, str):
-        #print ("str", str[:100])
-        assert str[:4] == b"MThd"
-        length, str = getNumber(str[4:], 4)
-        assert length == 6
-        format, str = getNumber(str, 2)
+        # the whole file is parsed from a single memoryview with an
+        # integer cursor, so the remaining buffer is never copied. str
+        # may be any buffer: bytes, bytearray or an mmap.
+        if self.lazy:
+            # the view is kept by the LazyTrackList until every track
+            # has been parsed
+            self.readAt(memoryview(str))
+        else:
+            with memoryview(str) as buf:
+                self.readAt(buf)
+
+    def readAt(self, buf):
+        #print ("buf", buf[:100])
+        format, numTracks, division, pos = readHeader(buf)
         #print ("Format: ", format)
         self.format = format
-        assert format == 0 or format == 1   # dunno how to handle 2
-        numTracks, str = getNumber(str, 2)
         #print ("Num Tracks: ", numTracks)
-        division, str = getNumber(str, 2)
         if division & 0x8000:
             framesPerSecond = -((division >> 8) | -128)
             ticksPerFrame = division & 0xFF
@@ -431,18 +887,68 @@ class MidiFile:
         else:
             self.ticksPerQuarterNote = division & 0x7FFF
             #print ("self.ticksPerQuarterNote ", self.ticksPerQuarterNote)
-        for i in range(numTracks):
-            trk = MidiTrack(i)
-            str = trk.read(str)
-            self.tracks.append(trk)
-
-        register_track0(self.tracks[0])
+        if self.lazy:
+            # only index the MTrk chunks, they are parsed on access
+            offsets = trackOffsets(buf, pos, numTracks)
+            self.tracks = LazyTrackList(buf, offsets, self)
+            return
+
+        if self.workers > 1:
+            offsets = trackOffsets(buf, pos, numTracks)
+            tracks = [self.newTrack(i) for i in range(numTracks)]
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                list(pool.map(lambda trk, pos: trk.readAt(buf, pos),
+                              tracks, offsets))
+            self.tracks.extend(tracks)
+        else:
+            for i in range(numTracks):
+                trk = self.newTrack(i)
+                pos = trk.readAt(buf, pos)
+                self.tracks.append(trk)
+
+        self.track0Hook(self.tracks[0])
+
+    def newTrack(self, index):
+        trk = self.trackClass(index)
+        trk.register_note = self.register_note
+        return trk
+
+    def track0Hook(self, trk):
+        hook = self.register_track0 or register_track0
+        hook(trk)
+
+    def tempoMap(self):
+        """TempoMap of the file, from the tempo changes of the first track"""
+        ticks, tempos = self.tracks[0].tempos()
+        return TempoMap(ticks, tempos, self.ticksPerQuarterNote,
+                        self.ticksPerSecond)
+
+    def notes(self, tracks=None):
+        """The notes of the given track indices (all tracks if None) as
+        one set of numpy arrays, see pairNotes"""
+        if tracks is None:
+            tracks = range(len(self.tracks))
+        notes = [self.tracks[i].notes() for i in tracks]
+        if not notes:
+            return pairNotes([], [], [], [], [], 0)
+        return Notes(*[np.concatenate(a) for a in zip(*notes)])
 
 
     def write(self):
-        self.file.write(self.writestr())
+        if self.file.seekable():
+            # stream the chunks straight into the file
+            self.writeTo(self.file)
+        else:
+            self.file.write(self.writestr())
 
     def writestr(self):
+        out = bytearray()
+        self.writeTo(out)
+        return bytes(out)
+
+    def writeTo(self, out):
+        """Write the whole file to out, a bytearray or a seekable binary
+        file, one chunk after the other."""
         division = self.ticksPerQuarterNote
         # Don't handle ticksPerSecond yet, too confusing
         assert (division & 0x8000) == 0
@@ -450,9 +956,57 @@ class MidiFile:
         str = str + putNumber(len(self.tracks), 2)
         str = str + putNumber(division, 2)
         #print ("str ", str)
+        if isinstance(out, bytearray):
+            out += str
+        else:
+            out.write(str)
         for trk in self.tracks:
-            str = str + trk.write()
-        return str
+            trk.writeTo(out)
+
+EventRecord = collections.namedtuple("EventRecord", ["time", "track", "type",
+                                                   "channel", "pitch",
+                                                   "velocity", "data"])
+
+def iter_events(path_or_buffer, track=None):
+    """Generator of the events of a MIDI file, read straight from the
+    bytes without building MidiTrack or MidiChannel objects. Yields
+    EventRecord tuples (time, track, type, channel, pitch, velocity, data)
+    with the absolute tick and the fields of the event, as MidiEvent would
+    hold them. Tracks come one after the other, in file order.
+
+    path_or_buffer is a file name (the file is memory-mapped) or any
+    buffer holding the file. If track is given, only the events of that
+    track are read."""
+    f = m = None
+    if isinstance(path_or_buffer, str):
+        f = open(path_or_buffer, "rb")
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        path_or_buffer = m
+    buf = memoryview(path_or_buffer)
+    try:
+        format, numTracks, division, pos = readHeader(buf)
+        offsets = trackOffsets(buf, pos, numTracks)
+        indices = range(numTracks) if track is None else [track]
+        for i in indices:
+            time = 0
+            status = None
+            length, pos = getNumberAt(buf, offsets[i] + 4, 4)
+            end = pos + length
+            while pos < end:
+                dt, pos = getVariableLengthNumberAt(buf, pos)
+                time = time + dt
+                (pos, status, type, channel, pitch, velocity,
+                 start, stop) = decodeEvent(buf, pos, status)
+                data = None
+                if start >= 0:
+                    data = eventData(type, buf[start:stop])
+                yield EventRecord(time, i, eventTypeNames[type], channel,
+                                  pitch, velocity, data)
+    finally:
+        buf.release()
+        if m is not None:
+            m.close()
+            f.close()
 
 def main(argv):
     global debugflag